@@ -43,7 +43,7 @@ DOCUMENTATION = """
               - section: pglook
                 key: host
           password: 
-            description: The database user password
+            description: The database user password. Not used by the 'sqlite' backend.
             required: true
             env:
               - name: ANSIBLE_PGLOOK_PASSWORD
@@ -61,9 +61,13 @@ DOCUMENTATION = """
           action: 
             description: >
               The non-read action specifier. 
-              Currently the only valid value is 'WRITE'. 
+              Valid values are 'WRITE', 'PATCH', 'FLUSH', 'SCAN' and 'SEARCH'.
               When WRITE is specified and the 'content' option is used, the value of 'content'
               will be written to the database.
+              PATCH merges the top level keys of 'content' into the stored document.
+              FLUSH writes out any queued write-behind data (see 'write_behind').
+              SCAN returns the documents whose keyname starts with 'prefix'.
+              SEARCH returns the documents that contain 'contains'.
 
             required: false
             env:
@@ -76,11 +80,114 @@ DOCUMENTATION = """
             required: false
             env:
               - name: ANSIBLE_PGLOOK_CONTENT
+          prefix: 
+            description: >
+            Keyname prefix matched by the SCAN action.
+
+            required: false
+          contains: 
+            description: >
+            JSON fragment matched by the SEARCH action, using the jsonb @> operator.
+
+            required: false
+          limit: 
+            description: >
+            Maximum number of documents returned by SCAN or SEARCH.
+
+            required: false
+            default: 100
+          after: 
+            description: >
+            Only return SCAN or SEARCH documents whose keyname sorts after this one.
+            Pass the last keyname of one page to get the next page.
+
+            required: false
+            default: ''
+          versioned: 
+            description: >
+            Read the stored version along with the data. The read returns a
+            dictionary with 'content' and 'version' keys; a missing keyname
+            has version 0.
+
+            required: false
+            default: false
+          expected_version: 
+            description: >
+            Only WRITE when the stored version still equals this value, as
+            returned by a versioned read. Use 0 to only create a new keyname.
+            A mismatch fails the lookup instead of overwriting the data.
+            Conditional writes ignore 'write_behind'.
+
+            required: false
+          backend: 
+            description: >
+            Where the data is stored. 'postgres' uses the tower_* stored procedures
+            in the database described by the options above. 'sqlite' uses a local
+            SQLite file (see 'path') and needs neither a server nor psycopg2.
+
+            required: false
+            default: 'postgres'
+            choices: ['postgres', 'sqlite']
+            env:
+              - name: ANSIBLE_PGLOOK_BACKEND
+            ini:
+              - section: pglook
+                key: backend
+          path: 
+            description: >
+            The SQLite database file used by the 'sqlite' backend.
+            It is created, in WAL mode, if it does not exist.
+
+            required: false
+            default: '~/.ansible/pglook.sqlite'
+            env:
+              - name: ANSIBLE_PGLOOK_PATH
+            ini:
+              - section: pglook
+                key: path
+          stats: 
+            description: >
+            Time each lookup, split into connect, execute, fetch, commit, decode
+            and encode, and count the JSON bytes moved. Shown at -vvv.
+
+            required: false
+            default: false
+            env:
+              - name: ANSIBLE_PGLOOK_STATS
+            ini:
+              - section: pglook
+                key: stats
+          stats_file: 
+            description: >
+            Append the same timings, one JSON object per lookup, to this file.
+
+            required: false
+            env:
+              - name: ANSIBLE_PGLOOK_STATS_FILE
+            ini:
+              - section: pglook
+                key: stats_file
+          write_behind: 
+            description: >
+            Queue WRITE and PATCH content in the controller process rather than
+            writing it immediately. Queued writes are coalesced per keyname and
+            written in one transaction by a FLUSH action or at process exit.
+
+            required: false
+            default: false
+            env:
+              - name: ANSIBLE_PGLOOK_WRITE_BEHIND
+            ini:
+              - section: pglook
+                key: write_behind
         notes:
-          - XXX
-          - XXX
+          - Queued write-behind data is lost if the process is killed before it is flushed.
+          - Write-behind failures at process exit can only be reported, not raised.
+          - Conditional writes take no locks; a concurrent writer makes the later one fail.
+          - The 'sqlite' backend answers SEARCH by reading documents in keyname order; there is no GIN index.
 """
 from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.plugins.lookup import LookupBase
 
 try:
@@ -89,13 +196,469 @@ except ImportError:
   from ansible.utils.display import Display
   display = Display()
 
-import psycopg2
+try:
+  import psycopg2
+  from psycopg2.extras import execute_batch, register_default_jsonb
+  HAS_PSYCOPG2 = True
+except ImportError:
+  HAS_PSYCOPG2 = False
+
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
 import json
+import os
 import re
+import sqlite3
+import time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Write-behind queue shared by every lookup in this process.
+# { backend queue key : (args, { keyname : [action, content] }) }
+_pending = {}
+_pending_pid = None
+
+def _coalesce(queue, keyname, action, content):
+  '''Fold a new write into the write already queued for keyname'''
+  queued = queue.get(keyname)
+  if queued is None or 'WRITE' == action:
+    queue[keyname] = [action, content]
+  elif isinstance(queued[1], dict):
+    # PATCH on top of a queued WRITE or PATCH keeps the queued action
+    merged = dict(queued[1])
+    merged.update(content)
+    queued[1] = merged
+  else:
+    # Same result tower_patcher gives for a non-object document
+    queue[keyname] = ['WRITE', content]
+
+def _json_type(value):
+  '''JSON type of a decoded value, bool is not a number as it is in python'''
+  if isinstance(value, bool):
+    return 'boolean'
+  if isinstance(value, (int, float)):
+    return 'number'
+  if isinstance(value, dict):
+    return 'object'
+  if isinstance(value, list):
+    return 'array'
+  if value is None:
+    return 'null'
+  return 'string'
+
+def _contains(doc, pattern, top=True):
+  '''Python equivalent of the jsonb @> operator'''
+  if isinstance(pattern, dict):
+    return isinstance(doc, dict) and all(
+      k in doc and _contains(doc[k], v, False) for k, v in pattern.items())
+  if isinstance(pattern, list):
+    return isinstance(doc, list) and all(
+      any(_contains(d, p, False) for d in doc) for p in pattern)
+  if top and isinstance(doc, list):
+    # jsonb lets a top level array contain a primitive, as if it were [ pattern ]
+    return any(_contains(d, pattern, False) for d in doc)
+  return _json_type(doc) == _json_type(pattern) and doc == pattern
+
+def _writer_call(writer, keyname, data):
+  '''Text of the writer function call, as psycopg2 renders it for the postgres backend'''
+  quote = lambda s: "'{0}'".format(s.replace("'", "''"))
+  return "SELECT * FROM {0}( {1}, {2}::jsonb )".format(writer, quote(keyname), quote(data))
+
+def _flush_pending():
+  '''Write all queued data, one transaction per database'''
+  global _pending
+  pending, _pending = _pending, {}
+
+  flushed = []
+  failed = []
+  for args, queue in pending.values():
+    backend = BACKENDS[args['backend']](args)
+    try:
+      backend.open()
+      try:
+        backend.batch(queue)
+      finally:
+        backend.close()
+      flushed.extend(queue)
+    except Exception as e:
+      failed.append("keys {0} ({1})".format(sorted(queue), e))
+    _report_stats(args, 'FLUSH', backend.stats)
+
+  return flushed, failed
+
+def _flush_at_exit():
+  '''Last chance flush of the write-behind queue'''
+  # Forked workers inherit this finalizer along with the parent's queue
+  if os.getpid() != _pending_pid:
+    return
+
+  flushed, failed = _flush_pending()
+  for f in failed:
+    display.error("postgresql plugin ERROR: write-behind data lost for {0}".format(f))
+
+def _report_stats(args, action, stats):
+  '''Emit the timing of one lookup, when asked to'''
+  if not args['stats'] and not args.get('stats_file'):
+    return
+
+  record = stats.record()
+  record['action'] = action or 'READ'
+  record['backend'] = args['backend']
+  record['keyname'] = args.get('keyname')
+  line = json.dumps(record, sort_keys=True)
+
+  if args['stats']:
+    display.vvv("pglook stats: {0}".format(line))
+
+  if args.get('stats_file'):
+    try:
+      with open(os.path.expanduser(args['stats_file']), 'a') as f:
+        f.write(line + "\n")
+    except (IOError, OSError) as e:
+      display.warning("pglook could not write stats_file ({0})".format(e))
+
+class Stats(object):
+  '''Time spent per phase of one lookup, and the JSON bytes moved'''
+
+  PHASES = ('connect', 'execute', 'fetch', 'commit', 'decode', 'encode')
+
+  def __init__(self):
+    '''The constructor'''
+    self.times = dict((p, 0.0) for p in self.PHASES)
+    self.bytes = 0
+
+  @contextmanager
+  def timed(self, phase):
+    '''Add the time spent in the with block to phase'''
+    start = _clock()
+    try:
+      yield
+    finally:
+      self.times[phase] += _clock() - start
+
+  def loads(self, data):
+    '''json.loads, timed and counted'''
+    if data is None:
+      return None
+    with self.timed('decode'):
+      doc = json.loads(data)
+    self.bytes += len(data)
+    return doc
+
+  def dumps(self, doc):
+    '''json.dumps, timed and counted'''
+    with self.timed('encode'):
+      data = json.dumps(doc)
+    self.bytes += len(data)
+    return data
+
+  def record(self):
+    '''Timings in milliseconds'''
+    record = dict((p, round(t * 1000, 3)) for p, t in self.times.items())
+    record['total'] = round(sum(self.times.values()) * 1000, 3)
+    record['bytes'] = self.bytes
+    return record
+
+class PostgresBackend(object):
+  '''Store data in PostgreSQL through the tower_* stored procedures'''
+
+  def __init__(self, args):
+    '''The constructor'''
+    self.args = args
+    self.conn = None
+    self.stats = Stats()
+
+  def connection_string(self):
+    '''Build DB connection string'''
+
+    args = self.args
+
+    return "dbname='{0}' user='{1}' host='{2}' password='{3}'".format(
+      args['dbname'],
+      args['user'],
+      args['host'],
+      args['password']
+    )
+
+  def queue_key(self):
+    '''Identify the write-behind queue for this database'''
+    args = self.args
+    return ('postgres', self.connection_string(), args['writer'], args['patcher'])
+
+  def open(self):
+    '''Connect to the database'''
+    if not HAS_PSYCOPG2:
+      raise AnsibleError("postgresql plugin ERROR: the postgres backend requires psycopg2")
+
+    try:
+      with self.stats.timed('connect'):
+        self.conn = psycopg2.connect(self.connection_string())
+    except:
+      raise AnsibleError("postgresql plugin ERROR: Unable to open db connection")
+
+    # Hand jsonb back as text so decoding is timed on its own
+    register_default_jsonb(self.conn, loads=lambda data: data)
+
+  def close(self):
+    '''Disconnect from the database'''
+    self.conn.close()
+
+  def _execute(self, statement, params):
+    '''Run one statement, returns the cursor'''
+    cur = self.conn.cursor()
+    with self.stats.timed('execute'):
+      cur.execute(statement, params)
+    return cur
+
+  def _commit(self):
+    '''Commit the current transaction'''
+    with self.stats.timed('commit'):
+      self.conn.commit()
+
+  def read(self, keyname):
+    '''Read existing data, None when keyname does not exist'''
+    reader = self.args['reader']
+    statement = "SELECT * FROM {0}(%(keyname)s) AS jdata".format(reader)
+    cur = self._execute(statement, { 'keyname': keyname })
+    with self.stats.timed('fetch'):
+      jdata = cur.fetchone()
+    cur.close()
+
+    return self.stats.loads(jdata[0])
+
+  def write(self, keyname, content, writer=None):
+    '''Update or insert new data'''
+    writer = writer or self.args['writer']
+    data = self.stats.dumps(content)
+    statement =  "SELECT * FROM {0}( %(name)s, %(jdata)s::jsonb )".format(writer)
+    cur = self._execute(statement, { 'name' : keyname, 'jdata' : data })
+
+    q = cur.query
+    self._commit()
+    cur.close()
+
+    return q.decode('utf-8') if isinstance(q, bytes) else q
+
+  def patch(self, keyname, content):
+    '''Merge new top level keys into existing data'''
+    return self.write(keyname, content, self.args['patcher'])
+
+  def batch(self, queue):
+    '''Apply queued writes and patches in one transaction'''
+    statements = {}
+    for keyname, (action, content) in queue.items():
+      fn = self.args['patcher'] if 'PATCH' == action else self.args['writer']
+      statements.setdefault(fn, []).append(
+        { 'name' : keyname, 'jdata' : self.stats.dumps(content) })
+
+    cur = self.conn.cursor()
+    for fn, rows in statements.items():
+      statement = "SELECT * FROM {0}( %(name)s, %(jdata)s::jsonb )".format(fn)
+      with self.stats.timed('execute'):
+        execute_batch(cur, statement, rows)
+    self._commit()
+    cur.close()
+
+  def find(self, finder, pattern, after, limit):
+    '''Read a page of matching keys and data in one query'''
+    statement = "SELECT * FROM {0}( %(pattern)s, %(after)s, %(limit)s )".format(finder)
+    cur = self._execute(statement, { 'pattern' : pattern, 'after' : after, 'limit' : limit })
+    with self.stats.timed('fetch'):
+      rows = cur.fetchall()
+    cur.close()
+
+    return [ (name, self.stats.loads(jdata)) for name, jdata in rows ]
+
+  def scan(self, prefix, after, limit):
+    '''Read a page of data by keyname prefix'''
+    return self.find(self.args['scanner'], prefix, after, limit)
+
+  def search(self, pattern, after, limit):
+    '''Read a page of data containing a JSON fragment'''
+    return self.find(self.args['searcher'], self.stats.dumps(pattern), after, limit)
+
+  def versioned_read(self, keyname):
+    '''Read existing data and its version, version 0 when keyname does not exist'''
+    reader = self.args['versioned_reader']
+    statement = "SELECT * FROM {0}(%(keyname)s)".format(reader)
+    cur = self._execute(statement, { 'keyname': keyname })
+    with self.stats.timed('fetch'):
+      row = cur.fetchone()
+    cur.close()
+
+    if row is None:
+      return None, 0
+
+    return self.stats.loads(row[0]), row[1]
+
+  def versioned_write(self, keyname, content, expected):
+    '''Write data if the version is unchanged, returns the new version or None'''
+    writer = self.args['versioned_writer']
+    statement = "SELECT {0}( %(name)s, %(jdata)s::jsonb, %(version)s )".format(writer)
+    cur = self._execute(statement, {
+      'name' : keyname,
+      'jdata' : self.stats.dumps(content),
+      'version' : expected
+    })
+    with self.stats.timed('fetch'):
+      version = cur.fetchone()[0]
+    self._commit()
+    cur.close()
+
+    return version
+
+class SqliteBackend(object):
+  '''Store data in a local SQLite file, same semantics as PostgresBackend'''
+
+  # Sorts after every character, so prefix + _LAST bounds a prefix scan
+  _LAST = u'\U0010ffff'
+
+  def __init__(self, args):
+    '''The constructor'''
+    self.args = args
+    self.conn = None
+    self.stats = Stats()
+
+  def queue_key(self):
+    '''Identify the write-behind queue for this database'''
+    return ('sqlite', os.path.abspath(os.path.expanduser(self.args['path'])))
+
+  def open(self):
+    '''Open, and if need be create, the database file'''
+    path = self.queue_key()[1]
+    try:
+      with self.stats.timed('connect'):
+        if not os.path.isdir(os.path.dirname(path)):
+          os.makedirs(os.path.dirname(path))
+        # Autocommit, transactions are explicit below
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+          "CREATE TABLE IF NOT EXISTS tower ("
+          " name TEXT PRIMARY KEY, jdata TEXT, version INTEGER NOT NULL DEFAULT 1)")
+    except (OSError, sqlite3.Error) as e:
+      raise AnsibleError("postgresql plugin ERROR: Unable to open sqlite db ({0})".format(e))
+
+  def close(self):
+    '''Close the database file'''
+    self.conn.close()
+
+  def _execute(self, statement, params=()):
+    '''Run one statement, returns the cursor'''
+    with self.stats.timed('execute'):
+      return self.conn.execute(statement, params)
+
+  def _fetch(self, keyname):
+    '''Row for keyname, or None'''
+    cur = self._execute("SELECT jdata, version FROM tower WHERE name = ?", (keyname,))
+    with self.stats.timed('fetch'):
+      return cur.fetchone()
+
+  def _upsert(self, keyname, content):
+    '''Update or insert new data, bumping the version'''
+    self._execute(
+      "INSERT INTO tower (name, jdata) VALUES (?, ?)"
+      " ON CONFLICT (name) DO UPDATE SET jdata = excluded.jdata, version = version + 1",
+      (keyname, self.stats.dumps(content)))
+
+  def _patch(self, keyname, content):
+    '''Merge new top level keys into existing data, inside a transaction'''
+    row = self._fetch(keyname)
+    queue = { keyname : ['WRITE', self.stats.loads(row[0]) if row else None] }
+    _coalesce(queue, keyname, 'PATCH', content)
+    self._upsert(keyname, queue[keyname][1])
+
+  def _transaction(self, fn, *args):
+    '''Run fn holding the write lock'''
+    self._execute("BEGIN IMMEDIATE")
+    try:
+      result = fn(*args)
+    except:
+      self.conn.execute("ROLLBACK")
+      raise
+    with self.stats.timed('commit'):
+      self.conn.execute("COMMIT")
+    return result
+
+  def read(self, keyname):
+    '''Read existing data, None when keyname does not exist'''
+    row = self._fetch(keyname)
+    return self.stats.loads(row[0]) if row else None
+
+  def write(self, keyname, content):
+    '''Update or insert new data'''
+    self._upsert(keyname, content)
+    return _writer_call(self.args['writer'], keyname, json.dumps(content))
+
+  def patch(self, keyname, content):
+    '''Merge new top level keys into existing data'''
+    self._transaction(self._patch, keyname, content)
+    return _writer_call(self.args['patcher'], keyname, json.dumps(content))
+
+  def batch(self, queue):
+    '''Apply queued writes and patches in one transaction'''
+    def apply():
+      for keyname, (action, content) in queue.items():
+        if 'PATCH' == action:
+          self._patch(keyname, content)
+        else:
+          self._upsert(keyname, content)
+    self._transaction(apply)
+
+  def scan(self, prefix, after, limit):
+    '''Read a page of data by keyname prefix'''
+    cur = self._execute(
+      "SELECT name, jdata FROM tower"
+      " WHERE name >= ? AND name < ? AND name > ? ORDER BY name LIMIT ?",
+      (prefix, prefix + self._LAST, after, limit))
+    with self.stats.timed('fetch'):
+      rows = cur.fetchall()
+    return [ (name, self.stats.loads(jdata)) for name, jdata in rows ]
+
+  def search(self, pattern, after, limit):
+    '''Read a page of data containing a JSON fragment'''
+    found = []
+    cur = self._execute(
+      "SELECT name, jdata FROM tower WHERE name > ? ORDER BY name", (after,))
+    while len(found) < limit:
+      with self.stats.timed('fetch'):
+        row = cur.fetchone()
+      if row is None:
+        break
+      doc = self.stats.loads(row[1])
+      if _contains(doc, pattern):
+        found.append((row[0], doc))
+
+    return found
+
+  def versioned_read(self, keyname):
+    '''Read existing data and its version, version 0 when keyname does not exist'''
+    row = self._fetch(keyname)
+    if row is None:
+      return None, 0
+
+    return self.stats.loads(row[0]), row[1]
+
+  def versioned_write(self, keyname, content, expected):
+    '''Write data if the version is unchanged, returns the new version or None'''
+    def apply():
+      row = self._fetch(keyname)
+      version = row[1] if row else 0
+      if version != expected:
+        return None
+      self._upsert(keyname, content)
+      return version + 1
+    return self._transaction(apply)
+
+BACKENDS = {
+  'postgres' : PostgresBackend,
+  'sqlite' : SqliteBackend
+}
 
 class LookupModule(LookupBase):
   args = None
-  conn = None
+  backend = None
 
   def process_args(self, kwargs):
     '''Process command input'''
@@ -109,25 +672,71 @@ class LookupModule(LookupBase):
       'dbname',
       'user',
       'host',
+      'password',
+      'backend',
+      'path',
       'reader',
       'writer',
+      'patcher',
+      'scanner',
+      'searcher',
       'action',
-      'content'
+      'content',
+      'prefix',
+      'contains',
+      'limit',
+      'after',
+      'versioned',
+      'expected_version',
+      'versioned_reader',
+      'versioned_writer',
+      'write_behind',
+      'stats',
+      'stats_file'
     ]
 
     args = {
       'dbname' : 'persist',
       'user' : 'persist',
       'host' : '127.0.0.1',
+      'backend' : 'postgres',
+      'path' : '~/.ansible/pglook.sqlite',
       'reader' : 'tower_reader',
-      'writer' : 'tower_writer'
+      'writer' : 'tower_writer',
+      'patcher' : 'tower_patcher',
+      'scanner' : 'tower_prefix_reader',
+      'searcher' : 'tower_contains_reader',
+      'versioned_reader' : 'tower_versioned_reader',
+      'versioned_writer' : 'tower_versioned_writer',
+      'versioned' : False,
+      'limit' : 100,
+      'after' : '',
+      'write_behind' : False,
+      'stats' : False
     }
 
     restricted = [
       'reader',
-      'writer'
+      'writer',
+      'patcher',
+      'scanner',
+      'searcher',
+      'versioned_reader',
+      'versioned_writer'
     ]
 
+    # Flushing uses the connection details stored with the queued data
+    if 'FLUSH' == kwargs.get('action'):
+      required = [ ]
+    elif 'SCAN' == kwargs.get('action'):
+      required = [ 'password', 'prefix' ]
+    elif 'SEARCH' == kwargs.get('action'):
+      required = [ 'password', 'contains' ]
+
+    # There is no password for a local file
+    if 'sqlite' == kwargs.get('backend') and 'password' in required:
+      required.remove('password')
+
     for r in required:
       if not r in kwargs:
         return False, "Found Missing a required argument: ({0})".format(r)
@@ -145,54 +754,124 @@ class LookupModule(LookupBase):
     if len(unknown) > 0:
         return False, "Found invalid key(s) in input ({0})".format(unknown)
 
+    if args['backend'] not in BACKENDS:
+      return False, "Unknown backend ({0})".format(args['backend'])
+
     # alpha numeric, underscore only
     pat = re.compile("\w+")
     for r in restricted:
       if not pat.match(args[r]):
         return False, "Malformed reader or writer ({0})".format(args[r])
 
-    return True, ''
+    for b in ('write_behind', 'versioned', 'stats'):
+      try:
+        args[b] = boolean(args[b], strict=True)
+      except TypeError:
+        return False, "Malformed {0} ({1})".format(b, args[b])
 
-  def connection_string(self, args):
-    '''Build DB connection string'''
+    if 'expected_version' in args:
+      try:
+        args['expected_version'] = int(args['expected_version'])
+      except (TypeError, ValueError):
+        return False, "Malformed expected_version ({0})".format(args['expected_version'])
+      if 'WRITE' != args.get('action'):
+        return False, "expected_version is only valid with WRITE"
 
-    args = self.args
+    if 'PATCH' == args.get('action') and not isinstance(args.get('content'), dict):
+      return False, "PATCH content must be a dictionary"
 
-    return "dbname='{0}' user='{1}' host='{2}' password='{3}'".format(
-      args['dbname'],
-      args['user'],
-      args['host'],
-      args['password']
-    )
+    try:
+      args['limit'] = int(args['limit'])
+    except (TypeError, ValueError):
+      return False, "Malformed limit ({0})".format(args['limit'])
+    if args['limit'] < 1:
+      return False, "Malformed limit ({0})".format(args['limit'])
+
+    return True, ''
 
   def read(self):
     '''Read existing data from db'''
+    keyname = self.args['keyname']
+
+    # Read our own queued writes
+    queued = _pending.get(self.backend.queue_key(), ({}, {}))[1].get(keyname)
+    if queued is not None and 'WRITE' == queued[0]:
+      return [ queued[1] ]
+
+    jdata = self.backend.read(keyname)
+
+    if queued is not None:
+      q = { keyname : ['WRITE', jdata] }
+      _coalesce(q, keyname, 'PATCH', queued[1])
+      jdata = q[keyname][1]
+
+    return [ jdata ]
+
+  def versioned_read(self):
+    '''Read existing data and its version from db'''
+    content, version = self.backend.versioned_read(self.args['keyname'])
+
+    return [ { 'content' : content, 'version' : version } ]
+
+  def versioned_write(self):
+    '''Write data only if nobody else has written since our read'''
     args = self.args
-    cur = self.conn.cursor()
-    keyname = args['keyname']
-    reader = self.args['reader']
-    statement = "SELECT * FROM {0}(%(keyname)s) AS jdata".format(reader)
-    cur.execute(statement, { 'keyname': keyname })
-    jdata = cur.fetchone()
-    cur.close()
+    version = self.backend.versioned_write(
+      args['keyname'], args['content'], args['expected_version'])
+
+    if version is None:
+      raise AnsibleError(
+        "postgresql plugin ERROR: version conflict on ({0}), expected version {1}".format(
+          args['keyname'], args['expected_version']))
 
-    return list(jdata)
+    return [ version ]
 
   def write(self):
     '''Update or insert new data'''
+    return [ self.backend.write(self.args['keyname'], self.args['content']) ]
+
+  def patch(self):
+    '''Merge new top level keys into existing data'''
+    return [ self.backend.patch(self.args['keyname'], self.args['content']) ]
+
+  def scan(self):
+    '''Read documents by keyname prefix'''
     args = self.args
-    cur = self.conn.cursor()
-    keyname = args['keyname']
-    writer = self.args['writer']
-    data = json.dumps(args['content'])
-    statement =  "SELECT * FROM {0}( %(name)s, %(jdata)s::jsonb )".format(writer)
-    cur.execute(statement, { 'name' : keyname, 'jdata' : data })
+    rows = self.backend.scan(args['prefix'], args['after'], args['limit'])
 
-    q = cur.query
-    self.conn.commit()
-    cur.close()
+    return [ { 'keyname' : name, 'content' : jdata } for name, jdata in rows ]
+
+  def search(self):
+    '''Read documents containing a JSON fragment'''
+    args = self.args
+    rows = self.backend.search(args['contains'], args['after'], args['limit'])
+
+    return [ { 'keyname' : name, 'content' : jdata } for name, jdata in rows ]
+
+  def enqueue(self):
+    '''Queue a WRITE or PATCH for a later flush'''
+    global _pending_pid
+    args = self.args
+
+    if _pending_pid != os.getpid():
+      # Anything inherited across a fork belongs to the parent
+      _pending.clear()
+      _pending_pid = os.getpid()
+      Finalize(None, _flush_at_exit, exitpriority=10)
+
+    queue = _pending.setdefault(self.backend.queue_key(), (dict(args), {}))[1]
+    _coalesce(queue, args['keyname'], args['action'], args['content'])
+
+    return [ "queued {0} for {1}".format(args['action'], args['keyname']) ]
 
-    return [ q ]
+  def flush(self):
+    '''Write out all queued data'''
+    flushed, failed = _flush_pending()
+    if failed:
+      raise AnsibleError("postgresql plugin ERROR: write-behind flush failed for {0}".format(
+        "; ".join(failed)))
+
+    return flushed
 
   def run(self, terms, variables=None, **kwargs):
     '''Main entry point of plugin'''
@@ -201,18 +880,34 @@ class LookupModule(LookupBase):
     if not success:
       raise AnsibleError("postgresql plugin ERROR: {0}".format(msg))
 
-    try:
-      self.conn = psycopg2.connect(self.connection_string(self.args))
-    except:
-      raise AnsibleError("postgresql plugin ERROR: Unable to open db connection")
-
+    action = self.args.get('action')
+    if 'FLUSH' == action:
+      return self.flush()
 
-    # Read when action isn't understood
-    if 'action' in self.args and 'WRITE' == self.args['action']:
-      return self.write()
-    else:
-      return self.read()
+    self.backend = BACKENDS[self.args['backend']](self.args)
 
-    self.conn.close()
+    conditional = 'expected_version' in self.args
+    if action in ('WRITE', 'PATCH') and self.args['write_behind'] and not conditional:
+      return self.enqueue()
 
-    return jdata
+    # Read when action isn't understood
+    try:
+      self.backend.open()
+      if 'WRITE' == action and conditional:
+        return self.versioned_write()
+      elif 'WRITE' == action:
+        return self.write()
+      elif 'PATCH' == action:
+        return self.patch()
+      elif 'SCAN' == action:
+        return self.scan()
+      elif 'SEARCH' == action:
+        return self.search()
+      elif self.args['versioned']:
+        return self.versioned_read()
+      else:
+        return self.read()
+    finally:
+      if self.backend.conn is not None:
+        self.backend.close()
+      _report_stats(self.args, action, self.backend.stats)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+''' Benchmark the pglook lookup plugin against a local database.
+'''
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+import os
+import sys
+import random
+import argparse
+import tempfile
+
+# pglook lives next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pglook
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+UNITS = { 'K' : 1024, 'M' : 1024 * 1024 }
+
+def parse_size(text):
+  '''Turn 1K, 10M etc. into bytes'''
+  text = text.strip().upper()
+  if text[-1] in UNITS:
+    return int(text[:-1]) * UNITS[text[-1]]
+  return int(text)
+
+def make_document(size):
+  '''A dict of roughly size bytes once encoded'''
+  # Each entry encodes to 64 bytes: "k0000000": "vvv...vvv",
+  count = max(1, size // 64)
+  return dict(("k%07d" % i, "v" * 50) for i in range(count))
+
+def percentile(values, pct):
+  '''Nearest rank percentile of a non empty list'''
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+def connection_args(args):
+  '''Lookup options selecting the database'''
+  if 'sqlite' == args.backend:
+    return { 'backend' : 'sqlite', 'path' : args.path }
+
+  return {
+    'backend' : 'postgres',
+    'dbname' : args.dbname,
+    'user' : args.user,
+    'host' : args.host,
+    'password' : args.password
+  }
+
+def run_mix(conn, size, read_ratio, iterations):
+  '''Time iterations lookups of one document size and read/write mix'''
+  keyname = "pglook_bench_{0}".format(size)
+  document = make_document(size)
+  pglook.LookupModule().run([], action='WRITE', keyname=keyname, content=document, **conn)
+
+  phases = dict((p, 0.0) for p in pglook.Stats.PHASES)
+  totals = []
+  for _ in range(iterations):
+    lookup = pglook.LookupModule()
+    start = pglook._clock()
+    if random.random() < read_ratio:
+      lookup.run([], keyname=keyname, **conn)
+    else:
+      lookup.run([], action='WRITE', keyname=keyname, content=document, **conn)
+    totals.append((pglook._clock() - start) * 1000)
+    for p, t in lookup.backend.stats.times.items():
+      phases[p] += t * 1000
+
+  row = {
+    'size' : size,
+    'read' : read_ratio,
+    'ops' : iterations,
+    'ops_s' : iterations / (sum(totals) / 1000),
+    'p50' : percentile(totals, 50),
+    'p95' : percentile(totals, 95),
+  }
+  for p, t in phases.items():
+    row[p] = t / iterations
+
+  return row
+
+def main():
+  '''Script entry point'''
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--backend', choices=['sqlite', 'postgres'], default='sqlite')
+  parser.add_argument('--path', default=None, help='sqlite file, a temporary one by default')
+  parser.add_argument('--dbname', default='persist')
+  parser.add_argument('--user', default='persist')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--password', default=os.environ.get('ANSIBLE_PGLOOK_PASSWORD'))
+  parser.add_argument('--sizes', default='1K,10K,100K,1M,10M',
+    help='comma separated document sizes')
+  parser.add_argument('--reads', default='1.0,0.5,0.0',
+    help='comma separated fractions of lookups that are reads')
+  parser.add_argument('--iterations', type=int, default=20)
+  args = parser.parse_args()
+
+  if 'postgres' == args.backend and not args.password:
+    sys.stderr.write("--password or ANSIBLE_PGLOOK_PASSWORD is required for postgres\n")
+    return EXIT_FAILURE
+
+  if 'sqlite' == args.backend and args.path is None:
+    args.path = os.path.join(tempfile.mkdtemp(prefix='pglook_bench'), 'bench.sqlite')
+
+  conn = connection_args(args)
+  columns = ['size', 'read', 'ops', 'ops_s', 'p50', 'p95'] + list(pglook.Stats.PHASES)
+  print("\t".join(columns))
+  for size in [ parse_size(s) for s in args.sizes.split(',') ]:
+    for read_ratio in [ float(r) for r in args.reads.split(',') ]:
+      row = run_mix(conn, size, read_ratio, args.iterations)
+      print("\t".join(
+        str(row[c]) if isinstance(row[c], int) else "{0:.3f}".format(row[c])
+        for c in columns))
+
+  return EXIT_SUCCESS
+
+if __name__ == '__main__':
+  sys.exit(main())
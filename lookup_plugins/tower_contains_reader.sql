@@ -0,0 +1,8 @@
+CREATE FUNCTION tower_contains_reader(the_pattern jsonb, the_after VARCHAR, the_limit INTEGER)
+  RETURNS TABLE(name VARCHAR, jdata jsonb) AS $$
+  SELECT t.name, t.jdata FROM tower t
+    WHERE t.jdata @> the_pattern
+      AND t.name COLLATE "C" > the_after
+    ORDER BY t.name COLLATE "C"
+    LIMIT the_limit;
+$$ LANGUAGE SQL STABLE;
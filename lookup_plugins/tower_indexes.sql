@@ -0,0 +1,4 @@
+-- Prefix scans (tower_prefix_reader) and keyset paging
+CREATE INDEX IF NOT EXISTS tower_name_c_idx ON tower (name COLLATE "C");
+-- Containment searches (tower_contains_reader)
+CREATE INDEX IF NOT EXISTS tower_jdata_idx ON tower USING GIN (jdata jsonb_path_ops);
@@ -0,0 +1,12 @@
+CREATE OR REPLACE FUNCTION tower_patcher(the_name VARCHAR, the_data jsonb) RETURNS void AS $$
+  INSERT INTO 
+    tower
+  VALUES(the_name, the_data)
+  ON CONFLICT (name)
+  DO UPDATE 
+  SET jdata = CASE
+    WHEN jsonb_typeof(tower.jdata) = 'object' THEN tower.jdata || the_data
+    ELSE the_data
+  END,
+  version = tower.version + 1;
+$$ LANGUAGE SQL;
@@ -0,0 +1,14 @@
+CREATE FUNCTION tower_prefix_reader(the_prefix VARCHAR, the_after VARCHAR, the_limit INTEGER)
+  RETURNS TABLE(name VARCHAR, jdata jsonb) AS $$
+BEGIN
+  -- A constant LIKE pattern lets the planner use tower_name_c_idx
+  RETURN QUERY EXECUTE format(
+    'SELECT t.name, t.jdata FROM tower t
+      WHERE t.name COLLATE "C" LIKE %L
+        AND t.name COLLATE "C" > $1
+      ORDER BY t.name COLLATE "C"
+      LIMIT $2',
+    replace(replace(replace(the_prefix, '\', '\\'), '%', '\%'), '_', '\_') || '%'
+  ) USING the_after, the_limit;
+END;
+$$ LANGUAGE plpgsql STABLE;
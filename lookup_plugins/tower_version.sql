@@ -0,0 +1,2 @@
+-- Adds the version column to a tower table created before versioned writes
+ALTER TABLE tower ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
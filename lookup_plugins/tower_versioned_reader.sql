@@ -0,0 +1,4 @@
+CREATE FUNCTION tower_versioned_reader(the_name VARCHAR)
+  RETURNS TABLE(jdata jsonb, version BIGINT) AS $$
+  SELECT t.jdata, t.version FROM tower t WHERE t.name = the_name;
+$$ LANGUAGE SQL STABLE;
@@ -0,0 +1,17 @@
+-- Returns the new version, or NULL when the_version is stale.
+-- A the_version of 0 only succeeds when the_name does not exist yet.
+CREATE FUNCTION tower_versioned_writer(the_name VARCHAR, the_data jsonb, the_version BIGINT)
+  RETURNS BIGINT AS $$
+  WITH updated AS (
+    UPDATE tower
+      SET jdata = the_data, version = tower.version + 1
+      WHERE tower.name = the_name AND tower.version = the_version AND the_version > 0
+      RETURNING tower.version
+  ), inserted AS (
+    INSERT INTO tower (name, jdata, version)
+      SELECT the_name, the_data, 1 WHERE the_version = 0
+      ON CONFLICT (name) DO NOTHING
+      RETURNING tower.version
+  )
+  SELECT version FROM updated UNION ALL SELECT version FROM inserted;
+$$ LANGUAGE SQL;
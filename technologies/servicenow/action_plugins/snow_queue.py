@@ -0,0 +1,213 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+ANSIBLE_METADATA = {  'metadata_version': '0.1',
+                      'status': ['preview'],
+                      'supported_by': 'agold@redhat.com'}
+DOCUMENTATION = """
+      action: snow_queue
+        author: Andrew Gold <agold@redhat.com>
+        version_added: "0.1"
+        short_description: Accumulate remediation outcomes on the controller
+        description:
+            - Remediation roles append the tickets they resolved or transferred
+            - Reporting collects the success and failure queues once, at the end of the play
+            - Appends are written to a file on the controller, so their cost is the size of
+              the tickets appended, not of the queues so far
+        options:
+          state:
+            description: >
+              reset empties the queues, append adds to them, collect returns them
+              as the success_queue and failure_queue facts and removes the file
+            required: false
+            default: append
+            choices: [ reset, append, collect ]
+          success:
+            description: Successfully remediated tickets to append
+            required: false
+            default: []
+          failure:
+            description: Unsuccessfully remediated tickets to append
+            required: false
+            default: []
+          path:
+            description: >
+              The accumulator file, by default one per ansible-playbook run in
+              ~/.ansible/snow_queue, a directory only its owner can use. The file
+              must belong to the user running the play and must not be a symlink.
+            required: false
+          keep:
+            description: Leave the file in place after collect
+            required: false
+            default: false
+        notes:
+          - >
+            collect returns success_queue, failure_queue, success_count and
+            failure_count, also set as facts
+"""
+
+EXAMPLES = '''
+- name: Start with empty queues
+  snow_queue:
+    state: reset
+
+- name: Queue remediation outcomes
+  snow_queue:
+    success: "{{ remediated.success }}"
+    failure: "{{ remediated.failure }}"
+
+- name: Collect the remediation queues
+  snow_queue:
+    state: collect
+
+- name: Report
+  debug:
+    msg: "{{ success_count }} remediated, {{ failure_count }} transferred"
+'''
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+import errno
+import fcntl
+import json
+import os
+import stat
+
+QUEUES = ('success', 'failure')
+
+# Private to the user, a shared temporary directory lets others plant or read the file
+DEFAULT_DIR = '~/.ansible/snow_queue'
+
+# os.open flags of the open modes used
+FLAGS = {
+  'a' : os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+  'r' : os.O_RDONLY,
+}
+
+def default_path():
+  '''Accumulator of this ansible-playbook run, the parent of the worker processes'''
+  directory = os.path.expanduser(DEFAULT_DIR)
+  try:
+    os.makedirs(directory, 0o700)
+  except OSError as e:
+    if errno.EEXIST != e.errno:
+      raise AnsibleError("snow_queue: unable to create {0} ({1})".format(directory, e))
+
+  info = os.lstat(directory)
+  if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+    raise AnsibleError(
+      "snow_queue: {0} must be a directory of this user's, closed to others".format(directory))
+
+  return os.path.join(directory, "{0}.jsonl".format(os.getppid()))
+
+class ActionModule(ActionBase):
+  '''Accumulate remediation outcomes on the controller'''
+  TRANSFERS_FILES = False
+
+  def _open(self, path, mode):
+    '''Open and lock the accumulator'''
+    try:
+      # Never through a symlink, and only a file of this user's
+      fd = os.open(path, FLAGS[mode] | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    except (IOError, OSError) as e:
+      raise AnsibleError("snow_queue: unable to open {0} ({1})".format(path, e))
+    f = os.fdopen(fd, mode)
+    try:
+      if os.fstat(fd).st_uid != os.getuid():
+        raise AnsibleError("snow_queue: {0} belongs to another user".format(path))
+      fcntl.flock(f, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+      f.close()
+      raise AnsibleError("snow_queue: unable to lock {0} ({1})".format(path, e))
+    except AnsibleError:
+      f.close()
+      raise
+    return f
+
+  def _append(self, path, args):
+    '''Append one line per ticket, returns the number appended'''
+    lines = []
+    for queue in QUEUES:
+      tickets = args.get(queue) or []
+      if not isinstance(tickets, list):
+        raise AnsibleError("snow_queue: {0} must be a list".format(queue))
+      lines.extend(json.dumps({ 'queue' : queue, 'ticket' : t }) + '\n' for t in tickets)
+
+    if lines:
+      f = self._open(path, 'a')
+      try:
+        f.writelines(lines)
+      finally:
+        f.close()
+    return len(lines)
+
+  def _collect(self, path, keep):
+    '''Queues in append order'''
+    queues = dict((queue, []) for queue in QUEUES)
+    try:
+      f = self._open(path, 'r')
+    except AnsibleError:
+      if not os.path.exists(path):
+        return queues
+      raise
+    try:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          queues[entry['queue']].append(entry['ticket'])
+      if not keep:
+        os.remove(path)
+    except (ValueError, KeyError) as e:
+      raise AnsibleError("snow_queue: corrupt accumulator {0} ({1})".format(path, e))
+    finally:
+      f.close()
+    return queues
+
+  def run(self, tmp=None, task_vars=None):
+    '''Action entry point'''
+    result = super(ActionModule, self).run(tmp, task_vars)
+    args = self._task.args
+    state = args.get('state', 'append')
+    path = os.path.expanduser(args.get('path') or default_path())
+
+    if 'reset' == state:
+      try:
+        os.remove(path)
+      except OSError as e:
+        if errno.ENOENT != e.errno:
+          raise AnsibleError("snow_queue: unable to remove {0} ({1})".format(path, e))
+      facts = { 'success_queue' : [], 'failure_queue' : [] }
+      result.update(changed=False, ansible_facts=facts, path=path)
+    elif 'append' == state:
+      appended = self._append(path, args)
+      result.update(changed=appended > 0, appended=appended, path=path)
+    elif 'collect' == state:
+      queues = self._collect(path, boolean(args.get('keep', False)))
+      facts = {}
+      for queue in QUEUES:
+        facts[queue + '_queue'] = queues[queue]
+        facts[queue + '_count'] = len(queues[queue])
+      result.update(facts)
+      result.update(changed=False, ansible_facts=facts, path=path)
+    else:
+      raise AnsibleError("snow_queue: unknown state ({0})".format(state))
+
+    return result
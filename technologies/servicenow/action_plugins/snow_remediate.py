@@ -0,0 +1,308 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+ANSIBLE_METADATA = {  'metadata_version': '0.1',
+                      'status': ['preview'],
+                      'supported_by': 'agold@redhat.com'}
+DOCUMENTATION = """
+      action: snow_remediate
+        author: Andrew Gold <agold@redhat.com>
+        version_added: "0.1"
+        short_description: Remediate a queue of SNOW tickets
+        description:
+            - Run the work in progress, remediate, resolve or transfer cycle for many tickets at once
+            - All tickets are marked work in progress with one bulk snow_update_ticket call
+            - Remediations then run concurrently on the controller, a wave at a time
+            - Remediated tickets are resolved, the others transferred, with one more bulk call
+            - Tickets that could not be marked work in progress are transferred unremediated
+        options:
+          tickets:
+            description: The active_queue from snow_ticket_processor
+            required: true
+          remediation:
+            description: >
+              The remediation to run. Only tickets whose remediation field
+              starts with it are processed. Must be a key of REMEDIATIONS.
+            required: true
+          host:
+            description: The SNOW host
+            required: true
+          user:
+            description: The SNOW user account
+            required: true
+          password:
+            description: The SNOW user account password
+            required: true
+          escalation_group:
+            description: Group unsuccessfully remediated tickets are transferred to
+            required: false
+            default: 'SERVICE DESK'
+          workers:
+            description: Number of remediations run at once, and of concurrent ticket updates
+            required: false
+            default: 10
+          group_limit:
+            description: >
+              Most remediations run at once for tickets of one escalation group,
+              0 for no limit other than workers
+            required: false
+            default: 0
+          group_limits:
+            description: Per escalation group overrides of group_limit
+            required: false
+            default: {}
+          batch_size:
+            description: Passed to snow_update_ticket, to update through the batch API
+            required: false
+            default: 0
+          use_ssl:
+            description: Connect over https. Set to false for a local test server.
+            required: false
+            default: true
+          timeout:
+            description: Passed to snow_update_ticket, seconds to wait for each API response
+            required: false
+          retries:
+            description: Passed to snow_update_ticket, times a failed request is repeated
+            required: false
+          rate_limit:
+            description: Passed to snow_update_ticket, requests per second shared with the other modules
+            required: false
+          state_labels:
+            description: >
+              Passed to snow_update_ticket, to recognize tickets already in progress
+              by their incident_state labels, which are not marked in progress again
+            required: false
+        notes:
+          - The remediations themselves are placeholders
+          - >
+            Tickets scheduled by snow_ticket_processor carry a wave number; each
+            wave is remediated only after the one before it has finished
+          - Nothing is updated or remediated in check mode
+          - >
+            Returns success and failure, the tickets resolved and transferred, and
+            results with the outcome of every ticket in input order
+          - >
+            Tickets neither resolved nor transferred, their last update having
+            failed, are returned as unfinished and fail the task, so that the
+            watermark is not committed past them and the next poll gets them again
+"""
+
+EXAMPLES = '''
+- name: Remediate complex tickets
+  snow_remediate:
+    host: "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    tickets: "{{ active_queue }}"
+    remediation: complex
+    workers: 20
+    group_limit: 5
+    group_limits:
+      "Wintel Support": 2
+  no_log: true
+  register: remediated
+
+- name: Queue remediation outcomes
+  snow_queue:
+    success: "{{ remediated.success }}"
+    failure: "{{ remediated.failure }}"
+'''
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from multiprocessing.pool import ThreadPool
+
+import threading
+
+try:
+  from __main__ import display
+except ImportError:
+  from ansible.utils.display import Display
+  display = Display()
+
+# snow_update_ticket options passed through as given
+UPDATE_OPTIONS = ('timeout', 'retries', 'rate_limit', 'rate_file', 'broker', 'broker_socket', 'state_labels')
+# Current fields of a snow_query_tickets result, so updates to them can be skipped
+CURRENT_FIELDS = ('incident_state', 'assignmentGroup', 'assigned_to')
+
+def remediate_placeholder(ticket):
+  '''Stand-in for actual remediation, succeeds when the ticket number ends in 5-9'''
+  return ticket['number'][-1:].isdigit() and int(ticket['number'][-1]) > 4
+
+# Remediation name to callable(ticket) returning True on success
+REMEDIATIONS = {
+  'complex' : remediate_placeholder,
+  'grouped' : remediate_placeholder,
+}
+
+class ActionModule(ActionBase):
+  '''Remediate a queue of SNOW tickets'''
+  TRANSFERS_FILES = False
+
+  def _update(self, tickets, task_vars):
+    '''One bulk snow_update_ticket call, returns the per-ticket results'''
+    args = self._task.args
+    module_args = {
+      'host' : args['host'],
+      'user' : args['user'],
+      'password' : args['password'],
+      'tickets' : tickets,
+      'escalation_group' : args.get('escalation_group', 'SERVICE DESK'),
+      'workers' : int(args.get('workers', 10)),
+      'batch_size' : int(args.get('batch_size', 0)),
+      'use_ssl' : boolean(args.get('use_ssl', True)),
+    }
+    # The rest of its options, when given
+    for name in UPDATE_OPTIONS:
+      if args.get(name) is not None:
+        module_args[name] = args[name]
+    result = self._execute_module(module_name='snow_update_ticket', module_args=module_args,
+      task_vars=task_vars)
+
+    # All failed, or a failure before any ticket was updated
+    if not isinstance(result.get('meta'), list):
+      msg = result.get('msg', 'snow_update_ticket failed')
+      return [ { 'failed' : True, 'msg' : msg } for t in tickets ]
+
+    return result['meta']
+
+  def _semaphores(self, tickets):
+    '''Semaphore per escalation group with a concurrency limit'''
+    args = self._task.args
+    limit = int(args.get('group_limit', 0))
+    limits = args.get('group_limits') or {}
+    semaphores = {}
+    for t in tickets:
+      group = t.get('escalationGroup') or ''
+      n = int(limits.get(group, limit))
+      if n > 0 and group not in semaphores:
+        semaphores[group] = threading.BoundedSemaphore(n)
+    return semaphores
+
+  def _remediate(self, remediate, semaphores, ticket):
+    '''Run one remediation, at most group limit at a time per escalation group'''
+    semaphore = semaphores.get(ticket.get('escalationGroup') or '')
+    if semaphore is not None:
+      semaphore.acquire()
+    try:
+      return { 'ok' : bool(remediate(ticket)) }
+    except Exception as e:
+      return { 'ok' : False, 'msg' : "Remediation error: ({0})".format(e) }
+    finally:
+      if semaphore is not None:
+        semaphore.release()
+
+  def run(self, tmp=None, task_vars=None):
+    '''Action entry point'''
+    result = super(ActionModule, self).run(tmp, task_vars)
+    args = self._task.args
+
+    for required in ('tickets', 'remediation', 'host', 'user', 'password'):
+      if args.get(required) is None:
+        raise AnsibleError("snow_remediate: {0} is required".format(required))
+
+    name = args['remediation']
+    if name not in REMEDIATIONS:
+      raise AnsibleError("snow_remediate: unknown remediation ({0})".format(name))
+    remediate = REMEDIATIONS[name]
+    tickets = [ t for t in args['tickets'] if (t.get('remediation') or '').startswith(name) ]
+
+    result.update(changed=False, success=[], failure=[], unfinished=[], results=[])
+    if not tickets:
+      return result
+    if self._play_context.check_mode:
+      result['msg'] = "check_mode so {0} tickets not remediated".format(len(tickets))
+      return result
+
+    # Work in progress, not repeated for tickets already in progress
+    wip = self._update([ dict(((k, t[k]) for k in CURRENT_FIELDS if t.get(k) is not None),
+        number=t['number'],
+        sys_id=t.get('sys_id'),
+        action='wip',
+        notes='Ansible remediation in progress',
+      ) for t in tickets ], task_vars)
+    outcomes = [ { 'number' : t['number'], 'state' : 'wip', 'failed' : w['failed'], 'msg' : w.get('msg') }
+      for t, w in zip(tickets, wip) ]
+    started = [ (t, o) for t, o in zip(tickets, outcomes) if not o['failed'] ]
+    unstarted = [ (t, o) for t, o in zip(tickets, outcomes) if o['failed'] ]
+    result['changed'] = len(started) > 0
+
+    # Remediate, by wave
+    workers = max(int(args.get('workers', 10)), 1)
+    semaphores = self._semaphores([ t for t, o in started ])
+    waves = { }
+    for j, (t, o) in enumerate(started):
+      waves.setdefault(t.get('wave') or 0, [ ]).append(j)
+    done = [ None ] * len(started)
+    pool = ThreadPool(min(workers, max(len(started), 1)))
+    try:
+      for wave in sorted(waves):
+        members = waves[wave]
+        finished = pool.map(lambda j: self._remediate(remediate, semaphores, started[j][0]), members)
+        for j, d in zip(members, finished):
+          done[j] = d
+    finally:
+      pool.close()
+
+    # Resolve or transfer, and hand over the tickets never started
+    closing = [ ]
+    notes = [ ]
+    for (t, o), d in zip(started, done):
+      o['state'] = 'resolve' if d['ok'] else 'transfer'
+      if d.get('msg'):
+        o['msg'] = d['msg']
+      outcome = 'successful' if d['ok'] else 'unsuccessful'
+      notes.append("Ansible remediation ({0}) was {1}".format(name, outcome))
+    for t, o in unstarted:
+      o.update(state='transfer', failed=False)
+      notes.append("Ansible remediation ({0}) could not be started".format(name))
+    for (t, o), note in zip(started + unstarted, notes):
+      closing.append({
+        'number' : t['number'],
+        'sys_id' : t.get('sys_id'),
+        'action' : o['state'],
+        'notes' : note,
+      })
+    closed = self._update(closing, task_vars)
+    for (t, o), c in zip(started + unstarted, closed):
+      if c['failed']:
+        o['failed'] = True
+        o['msg'] = c.get('msg')
+    result['changed'] = result['changed'] or any(not c['failed'] for c in closed)
+
+    for t, o in zip(tickets, outcomes):
+      if o['failed']:
+        result['unfinished'].append(t)
+      elif o['state'] == 'resolve':
+        result['success'].append(t)
+      else:
+        result['failure'].append(t)
+    result['results'] = outcomes
+
+    if result['unfinished']:
+      result['failed'] = True
+      result['msg'] = "{0} of {1} tickets were neither resolved nor transferred".format(
+        len(result['unfinished']), len(tickets))
+
+    display.vvv("snow_remediate: {0} {1} remediated, {2} failed".format(
+      len(result['success']), name, len(result['failure'])))
+
+    return result
@@ -31,28 +31,28 @@ DOCUMENTATION = """
         options:
           assigned_to: 
             description: The user to whom the ticket is assigned
-            required: true
+            required: false
             default: 'Ansible, User'
             ini:
               - section: snow_create_ticket
                 key: assigned_to
           assignment_group: 
             description: The group to whom the ticket is assigned
-            required: true
+            required: false
             default: 'ANSIBLE'
             ini:
               - section: snow_create_ticket
                 key: assignment_group
           escalation_group: 
             description: The group to whom the ticket is assigned
-            required: true
+            required: false
             default: 'SERVICE DESK'
             ini:
               - section: snow_create_ticket
                 key: escalation_group
           requestor: 
             description: The user who opened the ticket
-            required: true
+            required: false
             default: 'Ansible, User'
             ini:
               - section: snow_create_ticket
@@ -102,8 +102,78 @@ DOCUMENTATION = """
             ini:
               - section: snow_create_ticket
                 key: serviceName
+          tickets: 
+            description: >
+              List of tickets to create in one call. Each entry takes
+              short_description, remediation, server and serviceName, and may
+              override any of assigned_to, assignment_group, escalation_group
+              and requestor. The module level values are the defaults.
+              Returns the created number and sys_id of each, in input order.
+              The task fails only when every ticket fails. When some fail it
+              returns changed with a warning, failures set to their count and,
+              in each failed entry of meta, the ticket to retry; rerunning the
+              whole list would create the others again.
+            required: false
+          workers: 
+            description: >
+              Number of tickets created concurrently in bulk (tickets) mode,
+              or number of batch requests in flight when batch_size is set
+            required: false
+            default: 10
+            ini:
+              - section: snow_create_ticket
+                key: workers
+          batch_size: 
+            description: >
+              In bulk mode, send the creates through the ServiceNow batch API,
+              this many per request. 0 sends one request per ticket.
+            required: false
+            default: 0
+            ini:
+              - section: snow_create_ticket
+                key: batch_size
+          use_ssl: 
+            description: Connect over https. Set to false for a local test server.
+            required: false
+            default: true
+          timeout: 
+            description: Seconds to wait for each ServiceNow API response
+            required: false
+            default: 60
+          retries: 
+            description: >
+              Times a request is repeated after a connection failure or a 429, 502,
+              503 or 504 response, waiting longer each time and at least its
+              Retry-After. Creates and PATCH updates are only repeated when the
+              instance did not take the request (429, 503, connect timeout).
+            required: false
+            default: 3
+          rate_limit: 
+            description: >
+              Requests per second to the instance, shared by every snow_* module
+              running on the controller. The rate is halved when the instance
+              throttles and raised again while requests succeed; 0 starts
+              unlimited and adapts after the first throttle.
+            required: false
+            default: 0
+          rate_file: 
+            description: The file the modules share the rate through, by default ~/.ansible/snow_limiter.json
+            required: false
+          broker: 
+            description: >
+              Send requests through the local connection broker (tools/snow_brokerd.py)
+              when it is running, otherwise straight to the instance
+            required: false
+            default: true
+          broker_socket: 
+            description: The broker's Unix socket, by default $SNOW_BROKER_SOCKET or ~/.ansible/snow_broker.sock
+            required: false
         notes:
           - A note might be added here
+          - >
+            short_description, remediation, server, serviceName, assigned_to,
+            assignment_group, escalation_group and requestor are required for
+            every ticket, either as module options or in each tickets entry
 """
 
 EXAMPLES = '''
@@ -126,14 +196,55 @@ EXAMPLES = '''
 - name: Create first ticket output
   debug:
     msg: "{{ ct_result }}"
+
+- name: Seed a test queue
+  snow_create_ticket:
+    assignment_group: "{{ assignment_group }}"
+    escalation_group: "SERVICE DESK"
+    requestor: "Ansible, User"
+    assigned_to: "Ansible, User"
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    tickets:
+      - short_description: "load test ticket 1"
+        remediation: "complex"
+        server: "one.example.com"
+        serviceName: "daytime"
+      - short_description: "load test ticket 2"
+        remediation: "grouped"
+        server: "two.example.com"
+        serviceName: "nighttime"
+    workers: 20
+  no_log: true
+  register: ct_result
+
+- name: Retry the tickets that failed
+  snow_create_ticket:
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    tickets: "{{ ct_result.meta | selectattr('failed') | map(attribute='ticket') | list }}"
+  no_log: true
+  when: ct_result.failures | default(0) > 0
 '''
-from ansible.module_utils.basic import *
-import pysnow
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snow_batch import BatchRunner, operation
+from ansible.module_utils.snow_client import CLIENT_FIELDS, SnowClient
+from multiprocessing.pool import ThreadPool
+import json
+
+# Fields every ticket needs, from the module options or its tickets entry
+TICKET_FIELDS = ('short_description', 'remediation', 'server', 'serviceName')
+# Module options a tickets entry may override
+DEFAULT_FIELDS = ('assignment_group', 'escalation_group', 'requestor', 'assigned_to')
 
 class ThisModule(object):
   '''Create a ServiceNow trouble ticket'''
   _module = None
   _fields = None
+  _client = None
+  _failures = 0
 
   def __init__(self):
     '''The constructor'''
@@ -146,76 +257,144 @@ class ThisModule(object):
   def _set_fields(self):
     '''Configure module input'''
     self._fields = {
-      "short_description" : { "required": True, "type": "str" },
-      "assignment_group" : { "required": True, "type": "str" },
-      "remediation" : { "required": True, "type": "str" },
-      "serviceName" : { "required": True, "type": "str" },
-      "server" : { "required": True, "type": "str" },
-      "host" : { "required": True, "type": "str" },
-      "user" : { "required": True, "type": "str" },
-      "password" : { "required": True, "type": "str" },
-      'requestor': { "required": True, "type": "str" },
-      'assigned_to': { "required": True, "type": "str" },
-      'escalation_group': { "required": True, "type": "str" },
+      "short_description" : { "required": False, "type": "str" },
+      "assignment_group" : { "required": False, "type": "str" },
+      "remediation" : { "required": False, "type": "str" },
+      "serviceName" : { "required": False, "type": "str" },
+      "server" : { "required": False, "type": "str" },
+      'requestor': { "required": False, "type": "str" },
+      'assigned_to': { "required": False, "type": "str" },
+      'escalation_group': { "required": False, "type": "str" },
+      "tickets" : { "required": False, "type": "list" },
+      "workers" : { "required": False, "type": "int", "default": 10 },
+      "batch_size" : { "required": False, "type": "int", "default": 0 },
     }
+    self._fields.update(CLIENT_FIELDS)
 
-  def work(self):
-    '''Main application logic'''
+  def tickets(self):
+    '''Normalize single and bulk input into a list of ticket specs'''
+    params = self._module.params
+    entries = params['tickets']
+    if entries is None:
+      entries = [ {} ]
+
+    tickets = []
+    for e in entries:
+      if not isinstance(e, dict):
+        self._module.fail_json(msg="Invalid tickets entry: ({0})".format(e))
+      ticket = dict(e)
+      for k in TICKET_FIELDS + DEFAULT_FIELDS:
+        if ticket.get(k) is None:
+          ticket[k] = params.get(k)
+      missing = [ k for k in TICKET_FIELDS if not ticket[k] ]
+      missing.extend(k for k in DEFAULT_FIELDS if ticket[k] is None)
+      if missing:
+        self._module.fail_json(
+          msg="Missing field(s) {0} in ticket: ({1})".format(', '.join(missing), e))
+      tickets.append(ticket)
 
-    # 11 fields
-    short_description = self._module.params['short_description']
-    assignment_group = self._module.params['assignment_group']
-    remediation = self._module.params['remediation']
-    serviceName = self._module.params['serviceName']
-    server = self._module.params['server']
-    host = self._module.params['host']
-    user = self._module.params['user']
-    password = self._module.params['password']
-    requestor = self._module.params['requestor']
-    assigned_to = self._module.params['assigned_to']
-    escalation_group = self._module.params['escalation_group']
-
-    # Create client object
-    # 3 inputs used
-    c = pysnow.Client(host=host, user=user, password=password)
-    c.parameters.display_value = True
-    c.parameters.exclude_reference_link  = True
-    incident = c.resource(api_path='/table/incident')
+    return tickets
 
+  def client(self):
+    '''Create the client object shared by every ticket created'''
+    self._client = SnowClient(self._module.params, self._module.params['workers'])
+    return self._client
+
+  def payload(self, ticket):
+    '''Build the new record for one ticket spec'''
     description_pieces = []
 
     # 4 composite fields
-    description_pieces.append("Server=" + server)
-    description_pieces.append("Remediation=" + remediation)
-    description_pieces.append("ServiceName=" + serviceName)
-    description_pieces.append("EscalationGroup=" + escalation_group)
+    description_pieces.append("Server=" + ticket['server'])
+    description_pieces.append("Remediation=" + ticket['remediation'])
+    description_pieces.append("ServiceName=" + ticket['serviceName'])
+    description_pieces.append("EscalationGroup=" + ticket['escalation_group'])
     description = "~".join(description_pieces)
 
-    
     # "requestor in GUI, caller_id in data model
-    caller_id = requestor
+    caller_id = ticket['requestor']
 
     # Set the payload
     # 4 individual fields
     # 1 composite field of 4 inputs
-    # 3 individual fields used to create the connection (above)
-    # 11 fields total
-    new_record = {
+    return {
         'caller_id': caller_id,
-        #'assigned_to': assigned_to,
-        'short_description': short_description,
+        #'assigned_to': ticket['assigned_to'],
+        'short_description': ticket['short_description'],
         'description': description,
-        'assignment_group': assignment_group
+        'assignment_group': ticket['assignment_group']
     }
 
-    result = None
-
+  def create(self, incident, ticket):
+    '''Create one ticket, returns its result'''
     try:
-      result = incident.create(payload=new_record)
+      record = incident.create(payload=self.payload(ticket)).one()
     except Exception as e:
-      self._module.fail_json(msg="Query failure: ({0})".format(e))
+      return { 'failed' : True, 'msg' : "Query failure: ({0})".format(e) }
+
+    return { 'failed' : False, 'record' : record }
+
+  def batch_create(self, client, tickets):
+    '''Create tickets through the batch API, returns their results'''
+    runner = BatchRunner(
+      client.session,
+      client.base_url,
+      params={
+        'sysparm_display_value' : 'true',
+        'sysparm_exclude_reference_link' : 'true',
+      },
+      batch_size=self._module.params['batch_size'],
+      workers=self._module.params['workers'])
+
+    operations = [ operation('POST', '/table/incident', self.payload(t)) for t in tickets ]
+    return runner.run(operations)
+
+  def work(self):
+    '''Main application logic'''
+    tickets = self.tickets()
+    client = self.client()
+    incident = client.resource('/table/incident')
+
+    # Single ticket, original behavior
+    if self._module.params['tickets'] is None:
+      result = self.create(incident, tickets[0])
+      if result['failed']:
+        self._module.fail_json(msg=result['msg'])
+      return json.dumps(result['record'], indent=2)
+
+    if self._module.params['batch_size'] > 0:
+      outcomes = self.batch_create(client, tickets)
+    else:
+      pool = ThreadPool(max(self._module.params['workers'], 1))
+      try:
+        outcomes = pool.map(lambda t: self.create(incident, t), tickets)
+      finally:
+        pool.close()
+
+    results = []
+    for ticket, outcome in zip(tickets, outcomes):
+      result = { 'short_description' : ticket['short_description'], 'failed' : outcome['failed'] }
+      if outcome['failed']:
+        # The entry to pass to tickets again, to retry only the failures
+        result.update(msg=outcome['msg'], ticket=ticket)
+      else:
+        # Created, though a batch response may leave out the record
+        record = outcome['record'] or {}
+        result['number'] = record.get('number')
+        result['sys_id'] = record.get('sys_id')
+      results.append(result)
+
+    # The tickets created stay created, so only fail when there are none;
+    # rerunning the whole task would create them again
+    failed = [ r for r in results if r['failed'] ]
+    msg = "{0} of {1} ticket creations failed".format(len(failed), len(results))
+    if failed and len(failed) == len(results):
+      self._module.fail_json(msg=msg, meta=results)
+    if failed:
+      self._module.warn(msg + ", retry the tickets of the failed entries in meta")
 
-    return json.dumps(result.one(), indent=2)
+    self._failures = len(failed)
+    return results
 
 
   def run(self):
@@ -226,7 +405,8 @@ class ThisModule(object):
       retval = self.work()
       is_changed = True
 
-    self._module.exit_json(changed=is_changed, meta=retval)
+    api = self._client.stats() if self._client else {}
+    self._module.exit_json(changed=is_changed, meta=retval, failures=self._failures, api=api)
 
 if __name__ == '__main__':
     ThisModule().run()
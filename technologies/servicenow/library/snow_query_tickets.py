@@ -37,12 +37,26 @@ DOCUMENTATION = """
               - section: snow_query_tickets
                 key: minutes
           group: 
-            description: Retrieve tickets belonging to this group
-            required: true
+            description: Retrieve tickets belonging to this group. Use either group or groups.
+            required: false
             default: 'ANSIBLE'
             ini:
               - section: snow_query_tickets
                 key: group
+          groups: 
+            description: >
+              Retrieve tickets for several groups in one call. Entries are group
+              names, or dicts with group and optionally minutes to give that
+              group its own window. The groups are queried concurrently and
+              every result is tagged with its group. With a watermark, each
+              group keeps its own mark, named watermark:group.
+            required: false
+          combine: 
+            description: >
+              Query groups that share a window with one OR-ed encoded query
+              instead of one query each. Fewer requests, but a single slow query.
+            required: false
+            default: false
           host: 
             description: The SNOW host to which we connect
             required: true
@@ -62,8 +76,137 @@ DOCUMENTATION = """
             ini:
               - section: snow_query_tickets
                 key: password
+          page_size: 
+            description: >
+              Number of tickets fetched per request. Only the fields placed in
+              the results are requested, and each page is reduced to results
+              before the next one is fetched.
+            required: false
+            default: 500
+            ini:
+              - section: snow_query_tickets
+                key: page_size
+          slices: 
+            description: >
+              Split the window into this many equal time slices and query them
+              concurrently. 0 picks the number from the expected volume, one
+              slice per page_size tickets counted by the aggregate API, up to
+              workers. Results are merged, de-duplicated by sys_id and ordered
+              by openTime. Each group's window is sliced separately.
+            required: false
+            default: 1
+            ini:
+              - section: snow_query_tickets
+                key: slices
+          workers: 
+            description: Number of slices and groups queried at once
+            required: false
+            default: 8
+            ini:
+              - section: snow_query_tickets
+                key: workers
+          rules_file: 
+            description: >
+              YAML or JSON file of ticket format rules, tried before the
+              built-in ones when working out serviceName, remediation and
+              escalationGroup from a description. See module_utils/snow_parser.py.
+            required: false
+          watermark: 
+            description: >
+              Name under which to keep a high-water mark of the last change seen
+              (sys_updated_on plus sys_id). When set, a run after the first only
+              fetches tickets updated since the mark, less overlap, and drops the
+              ones it already returned. The first run uses the minutes window.
+            required: false
+          save_watermark: 
+            description: >
+              Save the moved watermark as soon as the tickets are returned. A
+              ticket whose processing then fails is not returned again unless it
+              changes, at most once delivery. Set to false to save it with commit
+              once the tickets are processed; a failed run then fetches them again.
+            required: false
+            default: true
+          commit: 
+            description: >
+              The watermark returned by an earlier run with save_watermark false,
+              saved under watermark (one per group with groups) without querying
+              for tickets
+            required: false
+          overlap: 
+            description: >
+              Seconds queried back from the watermark, to catch changes whose
+              timestamps arrive out of order or under clock skew
+            required: false
+            default: 300
+          state_backend: 
+            description: Where the watermark is kept, a local file or the pglook Postgres store
+            required: false
+            default: file
+            choices: [ file, postgres ]
+          state_path: 
+            description: The file used by the file state backend
+            required: false
+            default: ~/.ansible/snow_state.json
+          state_dbname: 
+            description: The pglook database, for the postgres state backend
+            required: false
+            default: persist
+          state_user: 
+            description: The pglook database user, for the postgres state backend
+            required: false
+            default: persist
+          state_host: 
+            description: The pglook database host, for the postgres state backend
+            required: false
+            default: 127.0.0.1
+          state_password: 
+            description: The pglook database password, for the postgres state backend
+            required: false
+          use_ssl: 
+            description: Connect over https. Set to false for a local test server.
+            required: false
+            default: true
+          timeout: 
+            description: Seconds to wait for each ServiceNow API response
+            required: false
+            default: 60
+          retries: 
+            description: >
+              Times a request is repeated after a connection failure or a 429, 502,
+              503 or 504 response, waiting longer each time and at least its
+              Retry-After. Creates and PATCH updates are only repeated when the
+              instance did not take the request (429, 503, connect timeout).
+            required: false
+            default: 3
+          rate_limit: 
+            description: >
+              Requests per second to the instance, shared by every snow_* module
+              running on the controller. The rate is halved when the instance
+              throttles and raised again while requests succeed; 0 starts
+              unlimited and adapts after the first throttle.
+            required: false
+            default: 0
+          rate_file: 
+            description: The file the modules share the rate through, by default ~/.ansible/snow_limiter.json
+            required: false
+          broker: 
+            description: >
+              Send requests through the local connection broker (tools/snow_brokerd.py)
+              when it is running, otherwise straight to the instance
+            required: false
+            default: true
+          broker_socket: 
+            description: The broker's Unix socket, by default $SNOW_BROKER_SOCKET or ~/.ansible/snow_broker.sock
+            required: false
         notes:
           - A note might be added here
+          - >
+            The watermark compares sys_updated_on as returned for the integration
+            user, which must use the default yyyy-MM-dd HH:mm:ss date format
+          - The watermark is not moved in check mode
+          - >
+            With the default save_watermark the tickets are delivered at most
+            once: a run that fails after the query does not get them again
 """
 
 EXAMPLES = '''
@@ -80,144 +223,443 @@ EXAMPLES = '''
 - name: Debug output
   debug: 
     msg: "{{ qt_result }}"
+
+- name: Catch up on a week of tickets after an outage
+  snow_query_tickets:
+    minutes: 10080
+    group: "ANSIBLE"
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    slices: 0
+  register: qt_result
+
+- name: Fetch only tickets changed since the last poll
+  snow_query_tickets:
+    minutes: 1440
+    group: "ANSIBLE"
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    watermark: "poll_ANSIBLE"
+    overlap: 120
+  register: qt_result
+
+- name: Poll, and move the watermark only after the tickets are worked
+  snow_query_tickets:
+    minutes: 1440
+    group: "ANSIBLE"
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    watermark: "poll_ANSIBLE"
+    save_watermark: false
+  register: qt_result
+
+# ... process and remediate the tickets ...
+
+- name: Commit the watermark
+  snow_query_tickets:
+    minutes: 1440
+    group: "ANSIBLE"
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    watermark: "poll_ANSIBLE"
+    commit: "{{ qt_result.watermark }}"
+
+- name: Poll several support queues at once
+  snow_query_tickets:
+    minutes: 60
+    groups:
+      - "ANSIBLE"
+      - "SERVICE DESK"
+      - group: "WINTEL"
+        minutes: 1440
+    combine: true
+    host:  "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+  register: qt_result
 '''
 
-from ansible.module_utils.basic import *
-import pysnow
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snow_client import CLIENT_FIELDS, SnowClient, query_builder
+from ansible.module_utils.snow_parser import DEFAULT_PARSER, Parser, RuleError
+from ansible.module_utils.snow_state import STATE_FIELDS, StateError, open_state
+from multiprocessing.pool import ThreadPool
 import json
-import re
 from datetime import datetime, timedelta
-from collections import defaultdict
+
+# The incident fields read into results; nothing else is fetched
+FIELDS = [
+  'number', 'sys_id', 'opened_at', 'assignment_group', 'short_description',
+  'description', 'u_host_name', 'incident_state', 'state', 'active',
+  'assigned_to', 'cmdb_ci', 'sys_updated_on', 'priority',
+]
+
+# sys_updated_on as displayed in the default date format
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 class ThisModule(object):
   '''Retrieve ServiceNow trouble ticket information'''
   _module = None
   _fields = None
+  _parser = DEFAULT_PARSER
+  _watermark = None
+  _changed = False
+  _client = None
 
   def __init__(self):
     '''The constructor'''
     self._set_fields()
     self._module = AnsibleModule(
       argument_spec=self._fields,
+      mutually_exclusive=[['group', 'groups']],
       supports_check_mode=True
     )
 
+    # Site rules are tried before the built-in ones
+    if self._module.params['rules_file']:
+      self._parser = Parser()
+      try:
+        self._parser.load(self._module.params['rules_file'])
+      except RuleError as e:
+        self._module.fail_json(msg="Rules failure: ({0})".format(e))
+
   def _set_fields(self):
     '''Configure input arguments'''
     self._fields = {
       "minutes" : { "required": True, "type": "int" },
-      "group" : { "required": True, "type": "str" },
-      "host" : { "required": True, "type": "str" },
-      "user" : { "required": True, "type": "str" },
-      "password" : { "required": True, "type": "str" },
+      "group" : { "required": False, "type": "str" },
+      "groups" : { "required": False, "type": "list" },
+      "combine" : { "required": False, "type": "bool", "default": False },
+      "page_size" : { "required": False, "type": "int", "default": 500 },
+      "slices" : { "required": False, "type": "int", "default": 1 },
+      "workers" : { "required": False, "type": "int", "default": 8 },
+      "rules_file" : { "required": False, "type": "path" },
+      "watermark" : { "required": False, "type": "str" },
+      "overlap" : { "required": False, "type": "int", "default": 300 },
+      "save_watermark" : { "required": False, "type": "bool", "default": True },
+      "commit" : { "required": False, "type": "dict" },
     }
+    self._fields.update(STATE_FIELDS)
+    self._fields.update(CLIENT_FIELDS)
 
   def parse_description(self, desc):
     '''Determine the type of remediation based on ticket description'''
+    return self._parser.parse(desc)
+
+  def result(self, record):
+    '''Reduce one incident record to its results entry'''
+    ticket_details = self.parse_description(record['description'])
 
-    description_details = {
-      'service_name':'', 
-      'remediation':'', 
-      'escalation_group':''
+    return {"number":record['number'], "sys_id":record['sys_id'], "openTime":record['opened_at'], "assignmentGroup":record['assignment_group'],\
+      "shortDesc":record['short_description'], "desc":record['description'], "server":record['u_host_name'],\
+      "serviceName":ticket_details['service_name'], "escalationGroup":ticket_details['escalation_group'], "remediation":ticket_details['remediation'], \
+      "incident_state":record['incident_state'], "state":record['state'], "active":record['active'], "assigned_to":record['assigned_to'], \
+      "cmdb_ci":record['cmdb_ci'], "u_host_name":record['u_host_name'], "updatedTime":record['sys_updated_on'], \
+      "priority":record['priority'], \
     }
-        
-    #Windows ntservices incidents
-    win_service_regex = re.compile('ntservices')
-    win_service_match = win_service_regex.search(desc)
-
-    #For demo tickets
-    demo_regex = re.compile('~EscalationGroup=')
-    demo_match = demo_regex.search(desc)
-
-    if win_service_match:
-        description_details['remediation'] = 'demo_service_restart'
-        description_details['escalation_group'] = 'Wintel Support'
-
-        #Extract the serviceName out of the description
-        service_regex = re.compile('(?<=ntservices:).+(?= -)')
-        service_match = service_regex.search(desc)
-        if service_match:
-            description_details['service_name'] = service_match.group()
-        else:
-            description_details['service_name'] = ''
-    elif demo_match:
-        description_details['service_name'] = 'demoService'
-        
-        #Set remediation value
-        remediation_regex = re.compile('(?<=Remediation=).+?(?=~)')
-        remediation_match = remediation_regex.search(desc)
-        if remediation_match:
-            description_details['remediation'] = remediation_match.group()
-        else:
-            description_details['remediation'] = ''
-
-        #Set escalation_group
-        escalation_regex = re.compile('(?<=EscalationGroup=).+?(?=~)')
-        escalation_match = escalation_regex.search(desc)
-        if escalation_match:
-            description_details['escalation_group'] = escalation_match.group()
-        else:
-            description_details['escalation_group'] = ''
-    else:
-        description_details['remediation'] = ''
-        description_details['service_name'] = ''
-        description_details['escalation_group'] = ''
 
-    return description_details
+  def groups(self):
+    '''Normalize group and groups into a list of { group, minutes, watermark }'''
+    params = self._module.params
+    entries = params['groups']
+    if entries is None:
+      # A single group keeps the watermark name as given
+      return [ { 'group' : params['group'] or 'ANSIBLE', 'minutes' : params['minutes'],
+        'watermark' : params['watermark'] } ]
 
-  def work(self):
-    '''Main application logic'''
-    #Query 2 months back. ANSIBLE test ticket was created on 5-18
-    minutes = self._module.params['minutes']
-    snow_group = self._module.params['group']
-    host = self._module.params['host']
-    user = self._module.params['user']
-    password = self._module.params['password']
-    
-    now = datetime.today()
-    minutes_delta = now - timedelta(minutes=minutes)
-    
-    # Create ServiceNow client object
-    c = pysnow.Client(host=host, user=user, password=password)
-    c.parameters.display_value = True
-    c.parameters.exclude_reference_link  = True
-    
-    # Query
+    groups = []
+    for e in entries:
+      if not isinstance(e, dict):
+        e = { 'group' : e }
+      if not e.get('group'):
+        self._module.fail_json(msg="Invalid groups entry: ({0})".format(e))
+      watermark = None
+      if params['watermark']:
+        watermark = "{0}:{1}".format(params['watermark'], e['group'])
+      groups.append({ 'group' : str(e['group']), 'minutes' : int(e.get('minutes') or params['minutes']),
+        'watermark' : watermark })
+
+    return groups
+
+  def query(self, unit, start, end, ordered=True):
+    '''Encoded query for the open tickets of a unit's groups created, or updated, between start and end'''
+    field = unit['field']
     qb = (
-        pysnow.QueryBuilder()
-        .field('sys_created_on').between(minutes_delta, now)
-        .AND()
-        .field('assignment_group').starts_with(snow_group)
+        query_builder()
+        .field(field).between(start, end)
         .AND()
+    )
+
+    # ^OR binds to the condition before it: window AND (group OR group) AND state
+    for i, group in enumerate(unit['groups']):
+      if i:
+        qb = qb.OR()
+      qb = qb.field('assignment_group').starts_with(group)
+
+    qb = (
+        qb.AND()
         .field('state').equals('true')
     )
 
-    incident = c.resource(api_path='/table/incident')
-  
+    # A stable order, so that pages neither overlap nor skip
+    if ordered:
+      qb = (
+        qb.AND()
+        .field(field).order_ascending()
+        .AND()
+        .field('sys_id').order_ascending()
+      )
+
+    return qb
+
+  def pages(self, incident, qb):
+    '''Yield the matching records one page at a time'''
+    page_size = max(self._module.params['page_size'], 1)
+    offset = 0
+    while True:
+      page = incident.get(query=qb, fields=FIELDS, limit=page_size, offset=offset).all()
+
+      yield page
+
+      if len(page) < page_size:
+        return
+      offset += page_size
+
+  def tag(self, result, unit):
+    '''Tag a result with the most specific of all the groups it belongs to'''
+    # STARTSWITH ignores case, so must the match
+    name = (result['assignmentGroup'] or '').lower()
+    matches = [ g for g in unit['all'] if name.startswith(g.lower()) ]
+    # Otherwise it can only belong to the groups queried for it
+    result['group'] = max(matches, key=len) if matches else unit['groups'][0]
+    return result
+
+  def fetch(self, task):
+    '''Results of one unit and time window, or the reason it failed'''
+    unit, (start, end) = task
+    results = []
     try:
-        response = incident.get(query=qb)
-    except pysnow.exceptions.ResponseError as e:
-       self._module.fail_json(msg="Query failure: ({0})".format(e))
-  
-    data = defaultdict(list)
-  
-    # Iterate over the matching records and print out number
-    for record in response.all():
-        ticket_details = self.parse_description(record['description'])
-
-        data['results'].append({"number":record['number'], "sys_id":record['sys_id'], "openTime":record['opened_at'], "assignmentGroup":record['assignment_group'],\
-          "shortDesc":record['short_description'], "desc":record['description'], "server":record['u_host_name'],\
-          "serviceName":ticket_details['service_name'], "escalationGroup":ticket_details['escalation_group'], "remediation":ticket_details['remediation'], \
-          "incident_state":record['incident_state'], "state":record['state'], "active":record['active'], "assigned_to":record['assigned_to'], \
-          "cmdb_ci":record['cmdb_ci'], "u_host_name":record['u_host_name'], \
-        })
+      # A resource of its own: the requests made through one pysnow resource
+      # share its query, limit and offset, so concurrent windows would page
+      # through each other's results
+      incident = self._client.client.resource(api_path='/table/incident')
+      for page in self.pages(incident, self.query(unit, start, end)):
+        tagged = [ self.tag(self.result(record), unit) for record in page ]
+        # A prefix also matches the tickets of longer group names, which
+        # belong to, and are fetched by, those groups' own queries
+        results.extend(r for r in tagged if r['group'] in unit['groups'])
+    except Exception as e:
+      return { 'failed' : True, 'msg' : "Query failure: ({0})".format(e) }
+
+    return { 'failed' : False, 'results' : results }
+
+  def count(self, c, unit, start, end):
+    '''Expected number of tickets, from the aggregate API'''
+    response = c.session.get(
+      c.base_url + '/api/now/stats/incident',
+      params={
+        'sysparm_count' : 'true',
+        'sysparm_query' : str(self.query(unit, start, end, ordered=False)),
+      },
+      headers={ 'Accept' : 'application/json' })
+    response.raise_for_status()
+
+    return int(response.json()['result']['stats']['count'])
+
+  def windows(self, start, end, slices):
+    '''Split start to end into slices consecutive windows, on whole seconds'''
+    step = (end - start) / slices
+    bounds = [ (start + step * i).replace(microsecond=0) for i in range(slices) ]
+    bounds.append(end)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+  def parse_time(self, text):
+    '''datetime of a sys_updated_on value'''
+    try:
+      return datetime.strptime(text, TIME_FORMAT)
+    except (TypeError, ValueError):
+      self._module.fail_json(
+        msg="Unexpected sys_updated_on format ({0}), the watermark needs {1}".format(text, TIME_FORMAT))
+
+  def advance(self, mark, results, now):
+    '''The watermark after results, with the tickets seen inside the overlap'''
+    overlap = timedelta(seconds=self._module.params['overlap'])
+    seen = dict(mark['seen']) if mark else {}
+    latest = (mark['updated_on'], mark['sys_id']) if mark else None
+
+    for r in results:
+      seen[r['sys_id']] = r['updatedTime']
+      key = (r['updatedTime'], r['sys_id'])
+      if latest is None or key > latest:
+        latest = key
+
+    # Nothing seen yet, the query covered everything up to now
+    if latest is None:
+      latest = (now.strftime(TIME_FORMAT), '')
+
+    # Only changes inside the overlap can be fetched again
+    cutoff = (self.parse_time(latest[0]) - overlap).strftime(TIME_FORMAT)
+    seen = dict((k, v) for k, v in seen.items() if v >= cutoff)
+
+    return { 'updated_on' : latest[0], 'sys_id' : latest[1], 'seen' : seen }
+
+  def units(self, groups, now):
+    '''Plan the queries: windows per group from minutes or watermark, combined if asked'''
+    overlap = timedelta(seconds=self._module.params['overlap'])
+    names = [ g['group'] for g in groups ]
+    units = []
+    for g in groups:
+      field, start, end = 'sys_created_on', now - timedelta(minutes=g['minutes']), now
+      if g.get('mark'):
+        # Resume from the watermark
+        field = 'sys_updated_on'
+        start = self.parse_time(g['mark']['updated_on']) - overlap
+        # Instance clock ahead of ours, still cover the overlap
+        end = max(now, start + overlap)
+      units.append({ 'groups' : [ g['group'] ], 'all' : names, 'field' : field,
+        'start' : start, 'end' : end })
+
+    if not self._module.params['combine']:
+      return units
+
+    combined = {}
+    for u in units:
+      key = (u['field'], u['start'], u['end'])
+      if key in combined:
+        combined[key]['groups'].extend(u['groups'])
+      else:
+        combined[key] = u
+    return list(combined.values())
+
+  def save(self, state, groups, marks):
+    '''Save each group's mark in marks, unless in check mode'''
+    if self._module.check_mode:
+      return
+    try:
+      for g in groups:
+        if g['group'] in marks:
+          state.save(g['watermark'], marks[g['group']])
+    except StateError as e:
+      self._module.fail_json(msg="Watermark failure: ({0})".format(e))
+
+  def commit(self, groups):
+    '''Save the watermark returned by an earlier run, without querying'''
+    params = self._module.params
+    if not params['watermark']:
+      self._module.fail_json(msg="commit needs the watermark name it was returned for")
+
+    marks = params['commit']
+    if params['groups'] is None:
+      marks = { groups[0]['group'] : marks }
+    for group, mark in marks.items():
+      if not isinstance(mark, dict) or 'updated_on' not in mark:
+        self._module.fail_json(msg="Invalid watermark for {0}: ({1})".format(group, mark))
+
+    try:
+      state = open_state(params)
+    except StateError as e:
+      self._module.fail_json(msg="Watermark failure: ({0})".format(e))
+    self.save(state, groups, marks)
+
+    self._watermark = params['commit']
+    self._changed = not self._module.check_mode
+    return json.dumps([])
+
+  def work(self):
+    '''Main application logic'''
+    slices = self._module.params['slices']
+    workers = max(self._module.params['workers'], 1)
+    groups = self.groups()
+
+    if self._module.params['commit'] is not None:
+      return self.commit(groups)
+    
+    now = datetime.today()
+
+    # Load the watermarks, if there are any
+    state = None
+    if self._module.params['watermark']:
+      try:
+        state = open_state(self._module.params)
+        for g in groups:
+          g['mark'] = state.load(g['watermark'])
+      except StateError as e:
+        self._module.fail_json(msg="Watermark failure: ({0})".format(e))
+    
+    # Create ServiceNow client object, one pooled connection per worker
+    c = self._client = SnowClient(self._module.params, workers)
+
+    tasks = []
+    for unit in self.units(groups, now):
+      count = slices
+      if count < 1:
+        try:
+          expected = self.count(c, unit, unit['start'], unit['end'])
+        except Exception as e:
+          self._module.fail_json(msg="Count failure: ({0})".format(e))
+        page_size = max(self._module.params['page_size'], 1)
+        count = min(max(-(-expected // page_size), 1), workers)
+      tasks.extend((unit, w) for w in self.windows(unit['start'], unit['end'], count))
+
+    if len(tasks) < 2:
+      fetched = [ self.fetch(t) for t in tasks ]
+    else:
+      pool = ThreadPool(min(workers, len(tasks)))
+      try:
+        fetched = pool.map(self.fetch, tasks)
+      finally:
+        pool.close()
+
+    for f in fetched:
+      if f['failed']:
+        self._module.fail_json(msg=f['msg'])
+
+    if len(fetched) == 1:
+      results = fetched[0]['results']
+    else:
+      # Slices share their boundary second, so a ticket may appear twice
+      merged = {}
+      for f in fetched:
+        for r in f['results']:
+          merged[r['sys_id']] = r
+      results = sorted(merged.values(), key=lambda r: (r['openTime'], r['sys_id']))
+
+    if state is not None:
+      marks = {}
+      kept = []
+      for g in groups:
+        mine = [ r for r in results if r['group'] == g['group'] ]
+        marks[g['group']] = self.advance(g['mark'], mine, now)
+        if g['mark']:
+          # Drop changes returned by an earlier run
+          seen = g['mark']['seen']
+          mine = [ r for r in mine if seen.get(r['sys_id']) != r['updatedTime'] ]
+        kept.extend(mine)
+      kept_ids = set(id(r) for r in kept)
+      results = [ r for r in results if id(r) in kept_ids ]
+
+      self._watermark = marks
+      if self._module.params['groups'] is None:
+        self._watermark = marks[groups[0]['group']]
+
+      # Otherwise the playbook saves it with commit, once the tickets are worked
+      if self._module.params['save_watermark']:
+        self.save(state, groups, marks)
   
-    return json.dumps(data['results'])
+    return json.dumps(results)
 
   def run(self):
     '''Application entry point'''
     ret_val = self.work()
-    self._module.exit_json(changed=False, meta=ret_val)
+    extra = { 'api' : self._client.stats() if self._client else {} }
+    if self._watermark is not None:
+      extra['watermark'] = self._watermark
+    self._module.exit_json(changed=self._changed, meta=ret_val, **extra)
 
 if __name__ == '__main__':
     ThisModule().run()
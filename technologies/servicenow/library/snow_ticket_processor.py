@@ -31,14 +31,170 @@ DOCUMENTATION = '''
             - Mark most recent ticket in each bucket as active.
             - Mark other tickets as cancelled. 
             - Cancel active tickets created within a change control window
+            - Schedule active tickets by priority and age, in waves within concurrency caps
+            - Escalate active tickets that cannot be worked before their deadline
             - Enable roles for all active tickets
         options:
           tickets: 
-            description: List of SNOW tickets from snow_query_tickets module.
-            required: true
+            description: List of SNOW tickets from snow_query_tickets module. Required unless commit is given.
+            required: false
+          time_format: 
+            description: >
+              strptime format of openTime, for instances not using the default
+              date format. Default format times are fixed width and compared
+              as they are.
+            required: false
+            default: '%Y-%m-%d %H:%M:%S'
+          index: 
+            description: >
+              Name under which to keep a bucket index across runs, from bucket
+              to the ticket last made active and when. A new ticket for a bucket
+              made active less than hold seconds ago is cancelled; the active
+              ticket itself, polled again, is held rather than remediated twice.
+            required: false
+          save_index: 
+            description: >
+              Save the active tickets to the index as soon as they are processed.
+              Set to false to save the returned index entries with commit once
+              the tickets are remediated; a run that fails before then leaves
+              their buckets free, so the tickets are remediated when polled again.
+            required: false
+            default: true
+          commit: 
+            description: >
+              The index entries returned by an earlier run with save_index false,
+              added to the index named by index without processing tickets
+            required: false
+          hold: 
+            description: Seconds a bucket suppresses new tickets after its ticket is made active
+            required: false
+            default: 3600
+          state_backend: 
+            description: Where the index is kept, a local file or the pglook Postgres store
+            required: false
+            default: file
+            choices: [ file, postgres ]
+          state_path: 
+            description: The file used by the file state backend
+            required: false
+            default: ~/.ansible/snow_state.json
+          state_dbname: 
+            description: The pglook database, for the postgres state backend
+            required: false
+            default: persist
+          state_user: 
+            description: The pglook database user, for the postgres state backend
+            required: false
+            default: persist
+          state_host: 
+            description: The pglook database host, for the postgres state backend
+            required: false
+            default: 127.0.0.1
+          state_password: 
+            description: The pglook database password, for the postgres state backend
+            required: false
+          change_windows: 
+            description: >
+              Change windows given inline, each with server and/or cmdb_ci (or a
+              targets list), start and end. Tickets opened inside a window of
+              their server or CI are cancelled as spurious.
+            required: false
+          host: 
+            description: >
+              The SNOW host. When set, windows are also read from change_request
+              (start_date, end_date, cmdb_ci), incrementally if change_cache is set.
+            required: false
+          user: 
+            description: The SNOW user account, with host
+            required: false
+          password: 
+            description: The SNOW user account password, with host
+            required: false
+          use_ssl: 
+            description: Connect over https. Set to false for a local test server.
+            required: false
+            default: true
+          timeout: 
+            description: Seconds to wait for each ServiceNow API response
+            required: false
+            default: 60
+          retries: 
+            description: >
+              Times a request is repeated after a connection failure or a 429, 502,
+              503 or 504 response, waiting longer each time and at least its
+              Retry-After. Creates and PATCH updates are only repeated when the
+              instance did not take the request (429, 503, connect timeout).
+            required: false
+            default: 3
+          rate_limit: 
+            description: >
+              Requests per second to the instance, shared by every snow_* module
+              running on the controller. The rate is halved when the instance
+              throttles and raised again while requests succeed; 0 starts
+              unlimited and adapts after the first throttle.
+            required: false
+            default: 0
+          rate_file: 
+            description: The file the modules share the rate through, by default ~/.ansible/snow_limiter.json
+            required: false
+          broker: 
+            description: >
+              Send requests through the local connection broker (tools/snow_brokerd.py)
+              when it is running, otherwise straight to the instance
+            required: false
+            default: true
+          broker_socket: 
+            description: The broker's Unix socket, by default $SNOW_BROKER_SOCKET or ~/.ansible/snow_broker.sock
+            required: false
+          change_cache: 
+            description: >
+              Name under which to keep the change_request windows between runs, in
+              the state store. Later runs only fetch changes updated since.
+            required: false
+          change_retention: 
+            description: Hours after its end a change window is kept
+            required: false
+            default: 168
+          remediation_limit: 
+            description: Most tickets of one remediation per wave, 0 for no limit
+            required: false
+            default: 0
+          remediation_limits: 
+            description: Per remediation overrides of remediation_limit
+            required: false
+            default: {}
+          server_limit: 
+            description: Most tickets of one server per wave, 0 for no limit
+            required: false
+            default: 0
+          deadlines: 
+            description: >
+              Minutes from openTime by which a ticket of a priority (1 to 5) must
+              be worked. Tickets whose wave would start later are escalated.
+            required: false
+            default: {}
+          wave_minutes: 
+            description: Expected minutes per wave, to estimate when a ticket is worked
+            required: false
+            default: 5
         notes:
-          - Change control window functionality is just a place holder
-          - A note might be added here
+          - >
+            Tickets are related when server, serviceName and remediation all
+            match. openTime is parsed once per ticket; the newest ticket of
+            each bucket stays active, ties going to the later one in the list.
+          - >
+            Active tickets are ordered by priority, then oldest first. Tickets
+            without a priority come last. Each gets a wave number; a wave holds
+            at most the remediation and server limits.
+          - >
+            meta is a dict of active (scheduled tickets), cancel (a flat list of
+            tickets), escalate (tickets past their deadline, to transfer), held
+            (active tickets of earlier runs, left alone), waves (the number of
+            waves) and roles (names of the <remediation>_role_enabled facts to set)
+          - The index is not updated in check mode
+          - >
+            With an index, the entries of this run's active tickets are returned
+            as index, to pass to commit
 '''
 
 EXAMPLES = '''
@@ -64,96 +220,316 @@ EXAMPLES = '''
   when: qt_result is defined
   register: post_process
 
+# Critical tickets first, one remediation per server at a time,
+# escalating P1 tickets that would wait more than 30 minutes
+- name: Process and schedule tickets
+  snow_ticket_processor:
+    tickets: "{{ qt_result.meta }}"
+    server_limit: 1
+    remediation_limits:
+      demo_service_restart: 20
+    deadlines:
+      1: 30
+      2: 240
+  register: post_process
+
 # Trace execution
 - name: Output processing results
   debug:
     msg: "{{ post_process }}"
 
 '''
-from ansible.module_utils.basic import *
-from random import randint
-from operator import itemgetter
-
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snow_changes import TIME_FORMAT, ChangeCache, ChangeIndex, time_key, window
+from ansible.module_utils.snow_client import SnowClient, client_fields, query_builder
+from ansible.module_utils.snow_state import STATE_FIELDS, StateError, open_state
+from datetime import datetime, timedelta
 import json
+import time
 
-try:
-  from __main__ import display
-except ImportError:
-  from ansible.utils.display import Display
-  display = Display()
+# change_request fields read into windows
+CHANGE_FIELDS = [ 'sys_id', 'start_date', 'end_date', 'cmdb_ci', 'active' ]
+CHANGE_PAGE = 1000
+# Seconds re-read before the last refresh, for changes saved out of order
+REFRESH_OVERLAP = 300
+# Rank of tickets without a priority, after 5 - Planning
+NO_PRIORITY = 6
 
 class ThisModule(object):
   '''Categorize and sort inbound tickets'''
   _module = None
   _fields = None
-  _active = [ ]
-  _cancel = [ ]
-  _roles  = [ ]
+  _client = None
+  _index = None
+  _changed = False
 
   def __init__(self):
     '''The constructor'''
+    self._active = [ ]
+    self._cancel = [ ]
+    self._held   = [ ]
+    self._escalate = [ ]
+    self._roles  = [ ]
+    self._waves  = 0
+    self._changes = None
     self._set_fields()
     self._module = AnsibleModule(
       argument_spec=self._fields,
+      required_one_of=[['tickets', 'commit']],
+      mutually_exclusive=[['tickets', 'commit']],
       supports_check_mode=True
     )
 
   def _set_fields(self):
     '''Configure module input arguments'''
     self._fields = {
-      "tickets" : { "required": True, "type": "list" },
+      "tickets" : { "required": False, "type": "list" },
+      "time_format" : { "required": False, "type": "str", "default": TIME_FORMAT },
+      "index" : { "required": False, "type": "str" },
+      "hold" : { "required": False, "type": "int", "default": 3600 },
+      "save_index" : { "required": False, "type": "bool", "default": True },
+      "commit" : { "required": False, "type": "dict" },
+      "change_windows" : { "required": False, "type": "list" },
+      "change_cache" : { "required": False, "type": "str" },
+      "change_retention" : { "required": False, "type": "int", "default": 168 },
+      "remediation_limit" : { "required": False, "type": "int", "default": 0 },
+      "remediation_limits" : { "required": False, "type": "dict", "default": {} },
+      "server_limit" : { "required": False, "type": "int", "default": 0 },
+      "deadlines" : { "required": False, "type": "dict", "default": {} },
+      "wave_minutes" : { "required": False, "type": "int", "default": 5 },
     }
+    self._fields.update(STATE_FIELDS)
+    self._fields.update(client_fields(required=False))
+
+  def bucket_key(self, ticket):
+    '''A unique event is a combination of these three fields'''
+    return (ticket['server'], ticket['serviceName'], ticket['remediation'])
+
+  def open_times(self, tickets):
+    '''Comparable openTime of every ticket, parsed once'''
+    time_format = self._module.params['time_format']
+    try:
+      return [ time_key(t['openTime'], time_format) for t in tickets ]
+    except (TypeError, ValueError) as e:
+      self._module.fail_json(msg="Unexpected openTime, set time_format: ({0})".format(e))
 
   def split_related_tickets(self, tickets):
-    '''Identify related tickets'''
-    buckets = { }
-    for ticket in tickets:
-      # A unique event is a combination of these three fields 
-      key = ticket['server'] + ticket['serviceName'] + ticket['remediation']
+    '''Keep the newest ticket of each bucket, cancel the rest, in one pass'''
+    newest = { }
+    for i, (ticket, opened) in enumerate(zip(tickets, self.open_times(tickets))):
+      key = self.bucket_key(ticket)
+      held = newest.get(key)
+      if held is None:
+        newest[key] = (opened, i)
+      elif opened >= held[0]:
+        self._cancel.append(tickets[held[1]])
+        newest[key] = (opened, i)
+      else:
+        self._cancel.append(ticket)
 
-      bucket = None
-      if key in buckets:
-        bucket = buckets[key]
-        bucket.append(ticket)
+    # Active tickets in input order
+    return [ tickets[i] for opened, i in sorted(newest.values(), key=lambda held: held[1]) ]
+
+  def index_key(self, key):
+    '''JSON object key of a bucket key'''
+    return json.dumps(key)
+
+  def suppress_indexed(self, tickets, index, now):
+    '''Set aside tickets of buckets made active within hold, returns the rest'''
+    hold = self._module.params['hold']
+    remaining = [ ]
+    for ticket in tickets:
+      entry = index.get(self.index_key(self.bucket_key(ticket)))
+      if entry is None or now - entry['since'] >= hold:
+        remaining.append(ticket)
+      elif entry['sys_id'] == ticket.get('sys_id'):
+        self._held.append(ticket)
       else:
-        bucket = [ticket]
-        buckets[key] = bucket
+        self._cancel.append(ticket)
+
+    return remaining
+
+  def index_entries(self, now):
+    '''Index entries of the active tickets'''
+    return dict((self.index_key(self.bucket_key(ticket)), {
+        'sys_id' : ticket.get('sys_id'),
+        'number' : ticket.get('number'),
+        'since' : now,
+      }) for ticket in self._active)
+
+  def update_index(self, index, entries, now):
+    '''index with entries recorded, dropping buckets past hold'''
+    hold = self._module.params['hold']
+    index = dict(index)
+    index.update(entries)
+    return dict((k, v) for k, v in index.items() if now - v['since'] < hold)
+
+  def commit(self, name):
+    '''Add the index entries returned by an earlier run, without processing tickets'''
+    entries = self._module.params['commit']
+    if not name:
+      self._module.fail_json(msg="commit needs the index name it was returned for")
+    for key, entry in entries.items():
+      if not isinstance(entry, dict) or 'since' not in entry:
+        self._module.fail_json(msg="Invalid index entry for {0}: ({1})".format(key, entry))
+
+    if not self._module.check_mode:
+      try:
+        state = open_state(self._module.params)
+        state.save(name, self.update_index(state.load(name) or { }, entries, time.time()))
+      except StateError as e:
+        self._module.fail_json(msg="Index failure: ({0})".format(e))
+      self._changed = True
 
-    return buckets.values()
+    return { }
+
+  def fetch_changes(self, since, oldest):
+    '''change_request windows updated after since, or all open ones ending after oldest'''
+    params = self._module.params
+    self._client = SnowClient(params)
+    changes = self._client.resource('/table/change_request')
+
+    if since is None:
+      qb = (
+        query_builder()
+        .field('end_date').greater_than(oldest)
+        .AND()
+        .field('active').equals('true')
+      )
+    else:
+      # Closed and cancelled changes too, so they leave the cache
+      qb = query_builder().field('sys_updated_on').greater_than(since)
+    qb = qb.AND().field('sys_id').order_ascending()
+
+    windows = [ ]
+    offset = 0
+    while True:
+      page = changes.get(query=qb, fields=CHANGE_FIELDS, limit=CHANGE_PAGE, offset=offset).all()
+      for r in page:
+        if r['start_date'] and r['end_date']:
+          windows.append(window([ r['cmdb_ci'] ], r['start_date'], r['end_date'],
+            id=r['sys_id'], active=r['active'] in ('true', True),
+            time_format=params['time_format']))
+      if len(page) < CHANGE_PAGE:
+        return windows
+      offset += CHANGE_PAGE
+
+  def load_changes(self, now):
+    '''Interval index of the change windows, None when none are configured'''
+    params = self._module.params
+    name = params['change_cache']
+    if not (params['change_windows'] or params['host']):
+      return None
+
+    oldest = now - timedelta(hours=params['change_retention'])
+
+    if params['host']:
+      cache = ChangeCache()
+      try:
+        if name:
+          state = open_state(params)
+          cache = ChangeCache(state.load(name))
+        since = None
+        if cache.refreshed:
+          since = datetime.strptime(cache.refreshed, TIME_FORMAT) - timedelta(seconds=REFRESH_OVERLAP)
+        cache.merge(self.fetch_changes(since, oldest))
+        cache.refreshed = now.strftime(TIME_FORMAT)
+        cache.prune(oldest.strftime(TIME_FORMAT))
+        if name and not self._module.check_mode:
+          state.save(name, cache.document())
+      except StateError as e:
+        self._module.fail_json(msg="Change cache failure: ({0})".format(e))
+      except Exception as e:
+        self._module.fail_json(msg="Change query failure: ({0})".format(e))
+      windows = list(cache.windows.values())
+    else:
+      windows = [ ]
+
+    # Inline windows are used as given, never cached
+    for w in params['change_windows'] or [ ]:
+      try:
+        targets = list(w.get('targets') or [ ]) + [ w.get('server'), w.get('cmdb_ci') ]
+        windows.append(window(targets, w['start'], w['end'], time_format=params['time_format']))
+      except (AttributeError, KeyError, TypeError, ValueError) as e:
+        self._module.fail_json(msg="Invalid change_windows entry: ({0}) ({1})".format(w, e))
+
+    return ChangeIndex(windows)
 
   def change_control_validation(self, tickets):
     '''Cancel tickets as spurious when a change control window is open'''
-    # Test each ticket against the change control window
+    # Test each ticket against the change control windows of its server and CI
     # Valid tickets go into the active bin
     # Invalid tickets go into the cancelled bin
+    if not self._changes:
+      self._active = tickets
+      return
 
-    # Simulate real change lookup by randomly cancelling 1:3 tickets
+    time_format = self._module.params['time_format']
+    for t in tickets:
+      try:
+        opened = time_key(t['openTime'], time_format)
+      except (TypeError, ValueError) as e:
+        self._module.fail_json(msg="Unexpected openTime, set time_format: ({0})".format(e))
+      if self._changes.covers((t['server'], t.get('cmdb_ci')), opened):
+        self._cancel.append(t)
+      else:
+        self._active.append(t)
 
-    #for t in tickets:
-    #  r = randint(0,2)
-    #  if 0 == r:
-     #   self._cancel.append(t)
-     # else:
-     #   self._active = tickets
-    self._active = tickets
-    
-  def time_sort_tickets(self, ticket_lists):
-    '''Sort related tickets by timestamp'''
+  def priority(self, ticket):
+    '''Rank of the priority, displayed as "1 - Critical" or given as a number'''
+    text = str(ticket.get('priority') or '').strip()
+    digits = text[:len(text) - len(text.lstrip('0123456789'))]
+    return int(digits) if digits else NO_PRIORITY
 
-    retval = [ ]
-    # sort each list of dict by embedded timestamp
-    for tl in ticket_lists:
-      s = sorted(tl, key=itemgetter('openTime'))
-      retval.append(s)
+  def deadline(self, rank, opened):
+    '''Time by which a ticket must be worked, None without a deadline'''
+    deadlines = self._module.params['deadlines']
+    minutes = deadlines.get(str(rank), deadlines.get(rank))
+    if minutes is None:
+      return None
+    return datetime.strptime(opened, TIME_FORMAT) + timedelta(minutes=int(minutes))
 
-    # Make most recent first
-    # The most recent ticket Will be marked active below
-    # This becomes important if we want to use persistent storage later
-    # for cross job run de-duplication 
+  def schedule(self, tickets, now):
+    '''Order by priority and age, assign waves within the limits, escalate late tickets'''
+    params = self._module.params
+    time_format = params['time_format']
+    remediation_limits = params['remediation_limits']
+    server_limit = params['server_limit']
+    try:
+      ranked = sorted(
+        ((self.priority(t), time_key(t['openTime'], time_format), i) for i, t in enumerate(tickets)))
+    except (TypeError, ValueError) as e:
+      self._module.fail_json(msg="Unexpected openTime, set time_format: ({0})".format(e))
 
-    retval.reverse()
+    # Tickets in each wave per remediation and per server, and the first wave with room
+    used = { }
+    first = { }
+    scheduled = [ ]
+    for rank, opened, i in ranked:
+      ticket = tickets[i]
+      caps = [ (('remediation', ticket['remediation']),
+          int(remediation_limits.get(ticket['remediation'], params['remediation_limit']))),
+        (('server', ticket['server']), server_limit) ]
+      caps = [ (key, limit) for key, limit in caps if limit > 0 ]
 
-    return retval
+      wave = max([ first.get(key, 0) for key, limit in caps ] or [ 0 ])
+      while any(used.get((key, wave), 0) >= limit for key, limit in caps):
+        wave += 1
+
+      deadline = self.deadline(rank, opened)
+      if deadline is not None and now + timedelta(minutes=wave * params['wave_minutes']) > deadline:
+        self._escalate.append(ticket)
+        continue
+
+      for key, limit in caps:
+        used[(key, wave)] = used.get((key, wave), 0) + 1
+        while used.get((key, first.get(key, 0)), 0) >= limit:
+          first[key] = first.get(key, 0) + 1
+      ticket['wave'] = wave
+      self._waves = max(self._waves, wave + 1)
+      scheduled.append(ticket)
+
+    return scheduled
 
   def enable_roles(self):
     '''Enable all roles for which there are open tickets'''
@@ -167,35 +543,59 @@ class ThisModule(object):
   def work(self):
     '''Main application logic'''
     tickets = self._module.params['tickets']
-    # find related tickets
-    buckets = self.split_related_tickets(tickets)
-    # sort related tickets by timestamp
-    time_sort = self.time_sort_tickets(buckets)
-
-    # All non-current duplicates should be cancelled
-    active = []
-    #f = open("tickets_obj.json", "w")
-    #f.write(json.dumps(tickets))
-    #f.close()
-    for ts in time_sort:
-      active.append(ts[0])
-      if len(ts) > 1:
-        self._cancel.append(ts[1:])
+    name = self._module.params['index']
+    now = time.time()
+
+    if self._module.params['commit'] is not None:
+      return self.commit(name)
+
+    # Buckets already in hand from earlier runs
+    index = None
+    if name:
+      try:
+        state = open_state(self._module.params)
+        index = state.load(name) or { }
+      except StateError as e:
+        self._module.fail_json(msg="Index failure: ({0})".format(e))
+      tickets = self.suppress_indexed(tickets, index, now)
+
+    # find related tickets, all non-current duplicates are cancelled
+    active = self.split_related_tickets(tickets)
 
     # test remaining tickets against change control window
+    today = datetime.today()
+    self._changes = self.load_changes(today)
     self.change_control_validation(active)
+
+    # most urgent first, escalating what cannot be worked in time
+    self._active = self.schedule(self._active, today)
     self.enable_roles()
 
-    return json.dumps({ 
+    if index is not None:
+      self._index = self.index_entries(now)
+      # Otherwise the playbook saves the entries with commit, once the tickets are remediated
+      if self._module.params['save_index'] and not self._module.check_mode:
+        try:
+          state.save(name, self.update_index(index, self._index, now))
+        except StateError as e:
+          self._module.fail_json(msg="Index failure: ({0})".format(e))
+
+    return { 
         'active': self._active, 
         'cancel': self._cancel,
+        'escalate' : self._escalate,
+        'held' : self._held,
+        'waves' : self._waves,
         'roles' : self._roles,
-      })
+      }
 
   def run(self):
     '''Application entry point'''
     ret_val = self.work()
-    self._module.exit_json(changed=False, meta=ret_val)
+    extra = { 'api' : self._client.stats() if self._client else {} }
+    if self._index is not None:
+      extra['index'] = self._index
+    self._module.exit_json(changed=self._changed, meta=ret_val, **extra)
 
 if __name__ == '__main__':
     ThisModule().run()
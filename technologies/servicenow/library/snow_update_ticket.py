@@ -48,11 +48,17 @@ DOCUMENTATION = """
               - section: snow_update_ticket
                 key: password
           incident: 
-            description: The SNOW incident ID 
-            required: true
+            description: The SNOW incident ID. Use either incident or tickets.
+            required: false
             ini:
               - section: snow_update_ticket
                 key: incident
+          sys_id: 
+            description: >
+              The SNOW sys_id of the incident, as returned by snow_query_tickets.
+              When given the ticket is patched directly; otherwise it is first looked
+              up by its incident ID, which costs an extra API call.
+            required: false
           action: 
             description: The type of updated to be performed
             required: true
@@ -75,9 +81,100 @@ DOCUMENTATION = """
             ini:
               - section: snow_update_ticket
                 key: escalation_group
+          tickets: 
+            description: >
+              List of tickets to update in one task, each a dict with an 'incident' key
+              and optionally 'sys_id', 'action', 'notes' and 'escalation_group'. Missing keys take
+              the value of the module option of the same name. Tickets as returned by
+              snow_query_tickets can be passed as they are; 'number' is used when
+              'incident' is missing. Their current fields are used to skip unchanged
+              ones, see skip_unchanged.
+              Use either incident or tickets.
+            required: false
+          current: 
+            description: >
+              The ticket's current fields, as returned by snow_query_tickets:
+              incident_state, assignmentGroup (or assignment_group) and assigned_to.
+              Used to skip unchanged ones, see skip_unchanged. Use with incident;
+              with tickets, each entry's own fields take its place.
+            required: false
+          skip_unchanged: 
+            description: >
+              Leave out of the update the incident_state, assignment_group and
+              assigned_to a ticket already has, going by its current fields. A ticket
+              already in every such state the action sets, a cancelled ticket being
+              cancelled again for example, is not updated at all. Fields whose current
+              value is not given are always sent, and so is state: the values the
+              actions write to it do not follow the stock choices yet (cancel sets 3,
+              On Hold).
+            required: false
+            default: true
+          state_labels: 
+            description: >
+              Choice value of each incident_state display label, for comparing
+              the labels snow_query_tickets returns with the values the actions
+              set. Case is ignored. The default is the stock incident_state
+              choice list, New 1, In Progress 2, On Hold 3, Resolved 6, Closed 7,
+              Canceled 8.
+            required: false
+          workers: 
+            description: >
+              Number of tickets updated concurrently in bulk (tickets) mode,
+              or number of batch requests in flight when batch_size is set
+            required: false
+            default: 10
+            ini:
+              - section: snow_update_ticket
+                key: workers
+          batch_size: 
+            description: >
+              In bulk mode, send the updates through the ServiceNow batch API,
+              this many per request. 0 sends one request per ticket.
+            required: false
+            default: 0
+            ini:
+              - section: snow_update_ticket
+                key: batch_size
+          use_ssl: 
+            description: Connect over https. Set to false for a local test server.
+            required: false
+            default: true
+          timeout: 
+            description: Seconds to wait for each ServiceNow API response
+            required: false
+            default: 60
+          retries: 
+            description: >
+              Times a request is repeated after a connection failure or a 429, 502,
+              503 or 504 response, waiting longer each time and at least its
+              Retry-After. Creates and PATCH updates are only repeated when the
+              instance did not take the request (429, 503, connect timeout).
+            required: false
+            default: 3
+          rate_limit: 
+            description: >
+              Requests per second to the instance, shared by every snow_* module
+              running on the controller. The rate is halved when the instance
+              throttles and raised again while requests succeed; 0 starts
+              unlimited and adapts after the first throttle.
+            required: false
+            default: 0
+          rate_file: 
+            description: The file the modules share the rate through, by default ~/.ansible/snow_limiter.json
+            required: false
+          broker: 
+            description: >
+              Send requests through the local connection broker (tools/snow_brokerd.py)
+              when it is running, otherwise straight to the instance
+            required: false
+            default: true
+          broker_socket: 
+            description: The broker's Unix socket, by default $SNOW_BROKER_SOCKET or ~/.ansible/snow_broker.sock
+            required: false
         notes:
           - Magic numbers are all from ServiceNow
-          - A note might be added here
+          - In bulk mode every ticket is updated over one shared HTTP session
+          - In bulk mode the task fails if any ticket update fails; meta holds every result
 """
 
 EXAMPLES = '''
@@ -87,6 +184,8 @@ EXAMPLES = '''
     user: "{{ snow_user }}"
     password: "{{ snow_password }}"
     incident: "{{ item.number }}"
+    sys_id: "{{ item.sys_id }}"
+    current: "{{ item }}"
     action: wip
     notes: "Ansible remediation in progress"
     escalation_group: "SERVICE DESK"
@@ -96,38 +195,90 @@ EXAMPLES = '''
   debug:
     msg: Actual remediation is performed here
 
+- name: Cancel duplicate tickets in bulk
+  snow_update_ticket:
+    host: "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    tickets: "{{ cancel_queue |flatten }}"
+    action: cancel
+    notes: "Ansible cancelation of duplicate ticket"
+    workers: 20
+  no_log: true
+
+- name: Cancel duplicate tickets, 50 per batch API request
+  snow_update_ticket:
+    host: "{{ snow_host }}"
+    user: "{{ snow_user }}"
+    password: "{{ snow_password }}"
+    tickets: "{{ cancel_queue |flatten }}"
+    action: cancel
+    batch_size: 50
+    workers: 4
+  no_log: true
 '''
 
-from ansible.module_utils.basic import *
-import pysnow
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snow_batch import BatchRunner, operation
+from ansible.module_utils.snow_client import CLIENT_FIELDS, SnowClient
+from multiprocessing.pool import ThreadPool
+import json
+
+# Fields an action may set that snow_query_tickets returns, by their name in its results
+# Not state, the actions' state values (the FIXMEs below) disagree with its choices
+CURRENT_FIELDS = {
+  'incident_state' : 'incident_state',
+  'assignment_group' : 'assignmentGroup',
+  'assigned_to' : 'assigned_to',
+}
+# Fields returned as display labels of a choice list
+CHOICE_FIELDS = ('incident_state',)
+# Stock incident_state choices, by display label
+STATE_LABELS = {
+  'new' : '1',
+  'in progress' : '2',
+  'on hold' : '3',
+  'resolved' : '6',
+  'closed' : '7',
+  'canceled' : '8',
+}
 
 class ThisModule(object):
   '''Update a ServiceNow trouble ticket'''
   _module = None
   _fields = None
+  _client = None
+  _changed = True
 
   def __init__(self):
     '''The constructor'''
     self._set_fields()
     self._module = AnsibleModule(
       argument_spec=self._fields,
+      required_one_of=[['incident', 'tickets']],
+      mutually_exclusive=[['incident', 'tickets'], ['sys_id', 'tickets'], ['current', 'tickets']],
       supports_check_mode=True
     )
 
   def _set_fields(self):
     '''Configure input arguments'''
     self._fields = {
-      "action" : { "required": True, "type": "str" },
-      "notes" : { "required": True, "type": "str" },
-      "escalation_group" : { "required": True, "type": "str" },
-
-      "incident" : { "required": True, "type": "str" },
-      "host" : { "required": True, "type": "str" },
-      "user" : { "required": True, "type": "str" },
-      "password" : { "required": True, "type": "str" }
+      "action" : { "required": False, "type": "str", "default": "comment" },
+      "notes" : { "required": False, "type": "str", "default": "Ansible updated" },
+      "escalation_group" : { "required": False, "type": "str", "default": "SERVICE DESK" },
+
+      "incident" : { "required": False, "type": "str" },
+      "sys_id" : { "required": False, "type": "str" },
+      "tickets" : { "required": False, "type": "list" },
+      "workers" : { "required": False, "type": "int", "default": 10 },
+      "batch_size" : { "required": False, "type": "int", "default": 0 },
+      "current" : { "required": False, "type": "dict" },
+      "skip_unchanged" : { "required": False, "type": "bool", "default": True },
+      "state_labels" : { "required": False, "type": "dict" },
     }
+    self._fields.update(CLIENT_FIELDS)
 
-  def action_cancel(self):
+  def action_cancel(self, ticket):
     '''Cancel a trouble ticket'''
     payload = {}
 
@@ -138,11 +289,11 @@ class ThisModule(object):
     payload["close_code"] = 'Cancelled'
     payload["active"] = 'false'
     payload["priority"] = '4'
-    payload["close_notes"] = self._module.params['notes']
+    payload["close_notes"] = ticket['notes']
     
     return payload
 
-  def action_close(self):
+  def action_close(self, ticket):
     '''Close a trouble ticket'''
 
     # yes, this is intentional
@@ -150,15 +301,15 @@ class ThisModule(object):
 
     return payload
 
-  def action_comment(self):
+  def action_comment(self, ticket):
     '''Commant/annotate a trouble ticket'''
     payload = {}
 
-    payload["work_notes"] = self._module.params['notes']
+    payload["work_notes"] = ticket['notes']
 
     return payload
 
-  def action_resolve(self):
+  def action_resolve(self, ticket):
     '''Resolve a trouble ticket'''
     payload = {}
 
@@ -169,72 +320,237 @@ class ThisModule(object):
     payload["close_code"] = 'Others'
     payload["u_others_please_specify"] = 'Ansible Resolved'
 
-    payload["work_notes"] = self._module.params['notes']
+    payload["work_notes"] = ticket['notes']
 
     return payload
 
-  def action_transfer(self):
+  def action_transfer(self, ticket):
     '''Transfer/escalate a trouble ticket'''
     payload = {}
     payload["state"] = '1'
     payload["incident_state"] = '1'
     payload["assigned_to"] = '' #need to fix unassign
-    payload["assignment_group"] = self._module.params['escalation_group']
-    payload["work_notes"] = self._module.params['notes']
+    payload["assignment_group"] = ticket['escalation_group']
+    payload["work_notes"] = ticket['notes']
 
     return payload
 
-  def action_wip(self):
+  def action_wip(self, ticket):
     '''Annotate a trouble ticket as work in progress'''
     payload = {}
     payload["assigned_to"] = 'Ansible, User'
     payload["state"] = '2'                          # FIXME magic number!
     payload["incident_state"] = '2'                 # FIXME magic number!
-    payload["work_notes"] = self._module.params['notes']
+    payload["work_notes"] = ticket['notes']
 
     return payload
 
-  def work(self):
-    '''Main application logic'''
-    host = self._module.params['host']
-    user = self._module.params['user']
-    password = self._module.params['password']
-
-    # Create client object
-    c = pysnow.Client(host=host, user=user, password=password)
-    c.parameters.display_value = True
-    c.parameters.exclude_reference_link  = True
-    c.parameters.add_custom({'sysparm_input_display_value': True})
-
-    incident = c.resource(api_path='/table/incident')
-
-    payload = {}
-    action = self._module.params['action']
+  def tickets(self):
+    '''Normalize single and bulk input into a list of tickets'''
+    params = self._module.params
+    entries = params['tickets']
+    if entries is None:
+      entries = [ dict(params['current'] or {}, incident=params['incident'], sys_id=params['sys_id']) ]
+
+    tickets = []
+    for e in entries:
+      if not isinstance(e, dict) or not (e.get('incident') or e.get('number')):
+        self._module.fail_json(msg="Invalid tickets entry: ({0})".format(e))
+      ticket = dict(e)
+      ticket.setdefault('incident', ticket.get('number'))
+      for k in ('action', 'notes', 'escalation_group'):
+        ticket.setdefault(k, params[k])
+      tickets.append(ticket)
+
+    return tickets
+
+  def client(self):
+    '''Create the client object shared by every ticket update'''
+    self._client = SnowClient(self._module.params, self._module.params['workers'], input_display_value=True)
+    return self._client
+
+  def payload(self, ticket):
+    '''Build the update payload for one ticket, None for an invalid action'''
+    action = ticket['action']
 
     if "cancel" == action:
-      payload = self.action_cancel()
+      return self.action_cancel(ticket)
     elif "close" == action:
-      payload = self.action_close()
+      return self.action_close(ticket)
     elif "comment" == action:
-      payload = self.action_comment()
+      return self.action_comment(ticket)
     elif "resolve" == action:
-      payload = self.action_resolve()
+      return self.action_resolve(ticket)
     elif "transfer" == action:
-      payload = self.action_transfer()
+      return self.action_transfer(ticket)
     elif "wip" == action:
-      payload = self.action_wip()
-    else:
-      self._module.fail_json(msg="Invalid action field: ({0})".format(action))
+      return self.action_wip(ticket)
+
+    return None
+
+  def current(self, ticket, field):
+    '''Current value of field as the actions set it, None when the ticket does not say'''
+    value = ticket.get(field)
+    if value is None:
+      value = ticket.get(CURRENT_FIELDS[field])
+    if value is None:
+      return None
+
+    value = str(value).strip()
+    if field in CHOICE_FIELDS:
+      labels = self._module.params['state_labels'] or STATE_LABELS
+      labels = dict((str(k).strip().lower(), str(v)) for k, v in labels.items())
+      value = labels.get(value.lower(), value)
+    return value
+
+  def changes(self, ticket, payload):
+    '''payload without the fields the ticket already has, None when there is nothing to send'''
+    if not self._module.params['skip_unchanged']:
+      return payload
+
+    tracked = [ f for f in CURRENT_FIELDS if f in payload ]
+    unchanged = [ f for f in tracked if self.current(ticket, f) == str(payload[f]).strip() ]
+    # Already in every state the action sets, the notes and codes that go with it were set then
+    if tracked and len(unchanged) == len(tracked):
+      return None
+
+    changes = dict((k, v) for k, v in payload.items() if k not in unchanged)
+    return changes or None
+
+  def prepare(self, ticket):
+    '''Result of one ticket and the payload to send, None when there is nothing to send'''
+    result = { 'incident' : ticket['incident'], 'action' : ticket['action'] }
+
+    payload = self.payload(ticket)
+    if payload is None:
+      result.update(failed=True, msg="Invalid action field: ({0})".format(ticket['action']))
+      return result, None
+    payload = self.changes(ticket, payload)
+    if payload is None:
+      result.update(failed=False, skipped=True)
+    return result, payload
+
+  def update(self, incident, ticket, result, payload):
+    '''Send one ticket's payload, filling in its result'''
+    try:
+      sys_id = ticket.get('sys_id')
+      if sys_id:
+        # One PATCH, no lookup by number
+        response = incident.request(
+          'PATCH', path_append='/' + sys_id, data=json.dumps(payload))
+      else:
+        response = incident.update(query={'number': ticket['incident']}, payload=payload)
+      result.update(failed=False, record=response.one())
+    except Exception as e:
+      result.update(failed=True, msg="Query failure: ({0})".format(e))
+
+    return result
+
+  def lookup_sys_ids(self, incident, tickets):
+    '''Fill in missing sys_ids, one query per 100 tickets'''
+    missing = [ t for t in tickets if not t.get('sys_id') ]
+    for start in range(0, len(missing), 100):
+      chunk = missing[start:start + 100]
+      query = 'numberIN' + ','.join(t['incident'] for t in chunk)
+      try:
+        records = incident.get(query=query, fields=['number', 'sys_id']).all()
+      except Exception as e:
+        self._module.fail_json(msg="Query failure: ({0})".format(e))
+      sys_ids = dict((r['number'], r['sys_id']) for r in records)
+      for t in chunk:
+        t['sys_id'] = sys_ids.get(t['incident'])
+
+  def resolve(self, incident, tickets):
+    '''Results of tickets, and the (ticket, result, payload) still to send with their sys_id'''
+    results = [ ]
+    sending = [ ]
+    for ticket in tickets:
+      result, payload = self.prepare(ticket)
+      results.append(result)
+      if payload is not None:
+        sending.append((ticket, result, payload))
+
+    # Only the tickets still to update need their sys_id
+    self.lookup_sys_ids(incident, [ ticket for ticket, result, payload in sending ])
+
+    found = [ ]
+    for ticket, result, payload in sending:
+      if not ticket['sys_id']:
+        result.update(failed=True, msg="Query failure: (No records found)")
+      else:
+        found.append((ticket, result, payload))
+
+    return results, found
+
+  def batch_update(self, client, incident, tickets):
+    '''Update tickets through the batch API, returns their results'''
+    params = self._module.params
+
+    results, sending = self.resolve(incident, tickets)
+
+    operations = [ ]
+    pending = [ ]
+    for ticket, result, payload in sending:
+      operations.append(operation('PATCH', '/table/incident/' + ticket['sys_id'], payload))
+      pending.append(result)
+
+    runner = BatchRunner(
+      client.session,
+      client.base_url,
+      params={
+        'sysparm_display_value' : 'true',
+        'sysparm_exclude_reference_link' : 'true',
+        'sysparm_input_display_value' : 'true',
+      },
+      batch_size=params['batch_size'],
+      workers=params['workers'])
+
+    for result, outcome in zip(pending, runner.run(operations)):
+      if outcome['failed']:
+        result.update(failed=True, msg=outcome['msg'])
+      else:
+        result.update(failed=False, record=outcome['record'])
+
+    return results
 
-    result = None
+  def work(self):
+    '''Main application logic'''
+    tickets = self.tickets()
+    client = self.client()
+    incident = client.resource('/table/incident')
+
+    # Single ticket, original behavior
+    if self._module.params['tickets'] is None:
+      result, payload = self.prepare(tickets[0])
+      if payload is not None:
+        self.update(incident, tickets[0], result, payload)
+      if result['failed']:
+        self._module.fail_json(msg=result['msg'])
+      if result.get('skipped'):
+        self._changed = False
+        return json.dumps(result, indent=2)
+      return json.dumps(result['record'], indent=2)
+
+    if self._module.params['batch_size'] > 0:
+      results = self.batch_update(client, incident, tickets)
+    else:
+      # Every worker sends a single PATCH by sys_id through its own pysnow resource,
+      # the query and update by number are a GET and a PUT that must not interleave
+      results, sending = self.resolve(incident, tickets)
+      pool = ThreadPool(max(self._module.params['workers'], 1))
+      try:
+        pool.map(lambda s: self.update(incident, *s), sending)
+      finally:
+        pool.close()
 
-    try: 
-      number = self._module.params['incident']
-      result = incident.update(query={'number': number}, payload=payload)
-    except Exception as e:
-      self._module.fail_json(msg="Query failure: ({0})".format(e))
+    failed = [ r for r in results if r['failed'] ]
+    if failed:
+      self._module.fail_json(
+        msg="{0} of {1} ticket updates failed".format(len(failed), len(results)),
+        meta=results)
 
-    return json.dumps(result.one(), indent=2)
+    self._changed = any(not r.get('skipped') for r in results)
+    return results
 
 
   def run(self):
@@ -243,9 +559,10 @@ class ThisModule(object):
     retval = { "notice" : "check_mode so no records updated" }
     if not self._module.check_mode:
       retval = self.work()
-      is_changed = True
+      is_changed = self._changed
 
-    self._module.exit_json(changed=is_changed, meta=retval)
+    api = self._client.stats() if self._client else {}
+    self._module.exit_json(changed=is_changed, meta=retval, api=api)
 
 if __name__ == '__main__':
     ThisModule().run()
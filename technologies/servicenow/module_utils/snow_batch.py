@@ -0,0 +1,154 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Run many ServiceNow table API operations through the batch API'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import json
+
+from multiprocessing.pool import ThreadPool
+
+try:
+  from urllib.parse import urlencode
+except ImportError:
+  from urllib import urlencode
+
+BATCH_PATH = '/api/now/v1/batch'
+TABLE_PATH = '/api/now'
+
+HEADERS = [
+  { 'name' : 'Content-Type', 'value' : 'application/json' },
+  { 'name' : 'Accept', 'value' : 'application/json' },
+]
+
+def operation(method, path, payload=None):
+  '''Describe one table API call, path is relative to /api/now'''
+  return { 'method' : method, 'path' : path, 'payload' : payload }
+
+def _encode(payload):
+  '''Batch API bodies are base64 encoded JSON'''
+  data = json.dumps(payload).encode('utf-8')
+  return base64.b64encode(data).decode('ascii')
+
+def _decode(body):
+  '''Inverse of _encode, tolerating an empty body'''
+  if not body:
+    return None
+  return json.loads(base64.b64decode(body).decode('utf-8'))
+
+class BatchRunner(object):
+  '''Pack table API operations into ServiceNow batch API requests
+
+  session    - requests.Session with authentication, e.g. pysnow Client.session
+  base_url   - https://<instance>, e.g. pysnow Client.base_url
+  params     - query parameters added to every operation (sysparm_display_value ...)
+  batch_size - operations per batch request
+  workers    - batch requests in flight at once
+  '''
+
+  def __init__(self, session, base_url, params=None, batch_size=50, workers=1):
+    '''The constructor'''
+    self._session = session
+    self._base_url = base_url
+    self._query = urlencode(params or {})
+    self._batch_size = max(batch_size, 1)
+    self._workers = max(workers, 1)
+
+  def _url(self, path):
+    '''Instance relative URL of one operation'''
+    url = TABLE_PATH + path
+    if self._query:
+      url += '?' + self._query
+    return url
+
+  def _request(self, batch_id, operations):
+    '''Build the body of one batch request'''
+    requests = []
+    for i, op in enumerate(operations):
+      request = {
+        'id' : str(i),
+        'method' : op['method'],
+        'url' : self._url(op['path']),
+        'headers' : HEADERS,
+        'exclude_response_headers' : True,
+      }
+      if op['payload'] is not None:
+        request['body'] = _encode(op['payload'])
+      requests.append(request)
+
+    return { 'batch_request_id' : str(batch_id), 'rest_requests' : requests }
+
+  def _unpack(self, operations, response):
+    '''Turn serviced and unserviced requests back into per-operation results'''
+    results = [ None ] * len(operations)
+
+    for served in response.get('serviced_requests', []):
+      i = int(served['id'])
+      status = served.get('status_code')
+      body = _decode(served.get('body'))
+      if status is not None and 200 <= status < 300:
+        record = body.get('result') if isinstance(body, dict) else body
+        results[i] = { 'failed' : False, 'status' : status, 'record' : record }
+      else:
+        error = body.get('error') if isinstance(body, dict) else body
+        results[i] = { 'failed' : True, 'status' : status,
+          'msg' : "{0} {1} ({2})".format(status, served.get('status_text', ''), error) }
+
+    for i, result in enumerate(results):
+      if result is None:
+        # Listed in unserviced_requests, or missing altogether
+        results[i] = { 'failed' : True, 'status' : None,
+          'msg' : "Not serviced by the batch API, resubmit" }
+
+    return results
+
+  def _send(self, batch):
+    '''Send one batch request, returns its per-operation results'''
+    batch_id, operations = batch
+    try:
+      response = self._session.post(
+        self._base_url + BATCH_PATH,
+        data=json.dumps(self._request(batch_id, operations)),
+        headers={ 'Content-Type' : 'application/json', 'Accept' : 'application/json' })
+      response.raise_for_status()
+      return self._unpack(operations, response.json())
+    except Exception as e:
+      failure = { 'failed' : True, 'status' : None, 'msg' : "Batch failure: ({0})".format(e) }
+      return [ dict(failure) for op in operations ]
+
+  def run(self, operations):
+    '''Run operations, returns their results in the same order'''
+    batches = []
+    for start in range(0, len(operations), self._batch_size):
+      batches.append((len(batches), operations[start:start + self._batch_size]))
+
+    if len(batches) < 2 or self._workers < 2:
+      chunks = [ self._send(b) for b in batches ]
+    else:
+      pool = ThreadPool(min(self._workers, len(batches)))
+      try:
+        chunks = pool.map(self._send, batches)
+      finally:
+        pool.close()
+
+    results = []
+    for chunk in chunks:
+      results.extend(chunk)
+
+    return results
@@ -0,0 +1,176 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Send ServiceNow requests through the local connection broker, tools/snow_brokerd.py
+
+The broker keeps keep-alive sessions to each instance between module runs, so a
+module run with connection: local skips the TLS handshake. Requests go over a
+Unix socket as plain HTTP with the instance URL as the target; when the broker
+is not running they go straight to the instance.
+'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import socket
+import threading
+
+from io import BytesIO
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ReadTimeout
+from urllib3 import HTTPResponse
+from urllib3.util.wait import wait_for_read
+
+try:
+  from http.client import HTTPConnection, HTTPException
+except ImportError:
+  from httplib import HTTPConnection, HTTPException
+
+# Where the broker listens unless SNOW_BROKER_SOCKET or broker_socket says otherwise
+DEFAULT_SOCKET = '~/.ansible/snow_broker.sock'
+
+# Headers that describe one hop, not the response
+HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-encoding')
+
+# Methods sent again when a kept-alive connection fails under them, as urllib3's Retry does
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+def socket_path(path=None):
+  '''The broker socket, from the argument, the environment or the default'''
+  return os.path.expanduser(path or os.environ.get('SNOW_BROKER_SOCKET') or DEFAULT_SOCKET)
+
+class UnixConnection(HTTPConnection):
+  '''HTTP over a Unix socket'''
+
+  def __init__(self, path, timeout):
+    '''The constructor'''
+    HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self._path = path
+
+  def connect(self):
+    '''Connect to the socket instead of a TCP port'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(self._path)
+    self.sock = sock
+
+class BrokerAdapter(HTTPAdapter):
+  '''Transport adapter relaying requests through the broker, direct when it is unavailable'''
+
+  def __init__(self, path, **kwargs):
+    '''The constructor'''
+    HTTPAdapter.__init__(self, **kwargs)
+    self._path = path
+    self._local = threading.local()
+    self.direct = False
+
+  def _connection(self, timeout):
+    '''This thread's connection to the broker'''
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = UnixConnection(self._path, timeout)
+      self._local.connection = connection
+    return connection
+
+  def _drop(self, connection):
+    '''Close this thread's broker connection, the next request opens a new one'''
+    connection.close()
+    self._local.connection = None
+
+  def _relay(self, connection, request):
+    '''Send request over connection, returns the urllib3 response'''
+    headers = dict(request.headers)
+    headers['Connection'] = 'keep-alive'
+    connection.request(request.method, request.url, body=request.body, headers=headers)
+    response = connection.getresponse()
+    data = response.read()
+
+    return HTTPResponse(body=BytesIO(data), status=response.status, reason=response.reason,
+      headers=[ (k, v) for k, v in response.getheaders() if k.lower() not in HOP_HEADERS ],
+      preload_content=False, decode_content=False)
+
+  def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+    '''Relay request, falling back to a direct connection when the broker is gone
+
+    Only a request that cannot have been sent is sent again: the broker
+    refused the connection, or, for idempotent methods, a kept-alive
+    connection failed under it. Anything else may have reached the instance
+    and is raised.
+    '''
+    if not self.direct:
+      wait = timeout[1] if isinstance(timeout, tuple) else timeout
+      idempotent = request.method.upper() in IDEMPOTENT
+      for attempt in range(2):
+        connection = self._connection(wait)
+        # Readable while idle means the broker closed it
+        if connection.sock is not None and wait_for_read(connection.sock, timeout=0.0):
+          self._drop(connection)
+          connection = self._connection(wait)
+
+        reused = connection.sock is not None
+        if not reused:
+          try:
+            connection.connect()
+          except (socket.error, IOError, OSError):
+            # Nothing sent, the broker is gone
+            self._drop(connection)
+            break
+
+        try:
+          return self.build_response(request, self._relay(connection, request))
+        except socket.timeout as e:
+          self._drop(connection)
+          raise ReadTimeout(e, request=request)
+        except (socket.error, IOError, OSError, HTTPException) as e:
+          self._drop(connection)
+          # Closed by the broker as the request went out, it may still have been relayed
+          if not (reused and idempotent):
+            raise ConnectionError(e, request=request)
+      self.direct = True
+
+    return HTTPAdapter.send(self, request, stream=stream, timeout=timeout, verify=verify,
+      cert=cert, proxies=proxies)
+
+  def close(self):
+    '''Close this thread's broker connection and the direct pool'''
+    connection = getattr(self._local, 'connection', None)
+    if connection is not None:
+      connection.close()
+    HTTPAdapter.close(self)
+
+def running(path):
+  '''True when a broker accepts connections on path'''
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.settimeout(1)
+    sock.connect(path)
+    return True
+  except (socket.error, IOError, OSError):
+    return False
+  finally:
+    sock.close()
+
+def session_adapter(params, workers):
+  '''Adapter to mount on a pysnow client session, with a pool of workers connections
+
+  Goes through the broker when the module's broker options allow it and one is running.
+  '''
+  path = socket_path(params.get('broker_socket'))
+  if params.get('broker', True) and os.path.exists(path) and running(path):
+    return BrokerAdapter(path, pool_connections=1, pool_maxsize=workers)
+
+  return HTTPAdapter(pool_connections=1, pool_maxsize=workers)
@@ -0,0 +1,116 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Change control windows: an interval index per server or CI, and a cache of windows'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+
+from bisect import bisect_right
+from datetime import datetime
+
+# Times as displayed in the default date format, which sorts as text
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIME_TEXT = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+
+def time_key(text, time_format=TIME_FORMAT):
+  '''Default format text of a displayed time, raises ValueError if it does not parse'''
+  if TIME_TEXT.match(text or ''):
+    return text
+  return datetime.strptime(text, time_format).strftime(TIME_FORMAT)
+
+def window(targets, start, end, id=None, active=True, time_format=TIME_FORMAT):
+  '''One normalized change window; targets are server names or CIs'''
+  targets = sorted(set(t for t in targets if t))
+  start = time_key(start, time_format)
+  end = time_key(end, time_format)
+  if id is None:
+    id = "{0}|{1}|{2}".format(','.join(targets), start, end)
+
+  return { 'id' : id, 'targets' : targets, 'start' : start, 'end' : end, 'active' : active }
+
+class ChangeIndex(object):
+  '''Merged windows per target, searched by bisection'''
+
+  def __init__(self, windows=()):
+    '''The constructor'''
+    spans = {}
+    for w in windows:
+      if not w['active']:
+        continue
+      for target in w['targets']:
+        spans.setdefault(target, []).append((w['start'], w['end']))
+
+    # Sorted, non-overlapping (start, end) lists per target
+    self._index = {}
+    for target, pairs in spans.items():
+      pairs.sort()
+      starts, ends = [ pairs[0][0] ], [ pairs[0][1] ]
+      for start, end in pairs[1:]:
+        if start <= ends[-1]:
+          ends[-1] = max(ends[-1], end)
+        else:
+          starts.append(start)
+          ends.append(end)
+      self._index[target] = (starts, ends)
+
+  def __len__(self):
+    '''Number of targets with windows'''
+    return len(self._index)
+
+  def covers(self, targets, when):
+    '''True when a window of any of targets contains the time key when'''
+    for target in targets:
+      spans = self._index.get(target)
+      if spans is None:
+        continue
+      starts, ends = spans
+      i = bisect_right(starts, when) - 1
+      if i >= 0 and when <= ends[i]:
+        return True
+
+    return False
+
+class ChangeCache(object):
+  '''Windows kept between polls, as a JSON document, refreshed incrementally'''
+
+  def __init__(self, document=None):
+    '''The constructor'''
+    document = document or {}
+    self.windows = dict(document.get('windows', {}))
+    self.refreshed = document.get('refreshed')
+
+  def merge(self, windows):
+    '''Add or replace windows by id; inactive ones (cancelled, closed) are removed'''
+    for w in windows:
+      if w['active']:
+        self.windows[w['id']] = w
+      else:
+        self.windows.pop(w['id'], None)
+
+  def prune(self, before):
+    '''Drop windows that ended before the time key before'''
+    self.windows = dict((k, w) for k, w in self.windows.items() if w['end'] >= before)
+
+  def index(self):
+    '''Interval index of the cached windows'''
+    return ChangeIndex(self.windows.values())
+
+  def document(self):
+    '''JSON document to save'''
+    return { 'windows' : self.windows, 'refreshed' : self.refreshed }
@@ -0,0 +1,260 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''The ServiceNow client the snow_* modules share: options, defaults, retries and timing
+
+pysnow and requests are imported when the first client or query is built, so a
+module run that never reaches the instance does not load them.
+'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import random
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+from ansible.module_utils.snow_limiter import RateLimiter
+
+# Module options of the instance connection, merged into a module's argument_spec
+CLIENT_FIELDS = {
+  "host" : { "required": True, "type": "str" },
+  "user" : { "required": True, "type": "str" },
+  "password" : { "required": True, "type": "str", "no_log": True },
+  "use_ssl" : { "required": False, "type": "bool", "default": True },
+  "timeout" : { "required": False, "type": "int", "default": 60 },
+  "retries" : { "required": False, "type": "int", "default": 3 },
+  "rate_limit" : { "required": False, "type": "float", "default": 0 },
+  "rate_file" : { "required": False, "type": "path" },
+  "broker" : { "required": False, "type": "bool", "default": True },
+  "broker_socket" : { "required": False, "type": "path" },
+}
+
+# Methods safe to repeat after a failure that may have reached the instance, as
+# urllib3's Retry has them; a PATCH with work notes adds them again
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+# Statuses worth retrying; only the throttling ones (not served at all) for the other methods
+RETRY_STATUSES = (502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+# Seconds before the first retry, doubled for each one after it, at most BACKOFF_MAX
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+# Longest Retry-After honored, in seconds
+RETRY_AFTER_MAX = 300
+
+def client_fields(required=True):
+  '''CLIENT_FIELDS, with host, user and password optional unless required'''
+  fields = dict((k, dict(v)) for k, v in CLIENT_FIELDS.items())
+  for name in ('host', 'user', 'password'):
+    fields[name]['required'] = required
+  return fields
+
+def query_builder():
+  '''A new pysnow QueryBuilder'''
+  import pysnow
+  return pysnow.QueryBuilder()
+
+def retry_after(response):
+  '''Seconds a response's Retry-After asks for, 0 without one'''
+  value = response.headers.get('Retry-After')
+  if not value:
+    return 0
+  try:
+    seconds = float(value)
+  except ValueError:
+    # An HTTP date
+    parsed = parsedate_tz(value)
+    if parsed is None:
+      return 0
+    seconds = mktime_tz(parsed) - time.time()
+  return min(max(seconds, 0), RETRY_AFTER_MAX)
+
+class RequestPolicy(object):
+  '''Timeout, retries, rate limit and timing applied to every request of a session'''
+
+  def __init__(self, timeout=60, retries=3, limiter=None):
+    '''The constructor'''
+    self.timeout = timeout
+    self.retries = max(retries, 0)
+    self.limiter = limiter
+    self._lock = threading.Lock()
+    self._stats = { 'calls' : 0, 'retries' : 0, 'throttled' : 0, 'waited' : 0.0,
+      'seconds' : 0.0, 'slowest' : 0.0 }
+
+  def retryable(self, method, status=None, error=None):
+    '''True when a failed attempt may be repeated'''
+    import requests
+    if error is not None:
+      # A refused or timed out connection never reached the instance
+      if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+      return method in IDEMPOTENT and isinstance(error, (requests.ConnectionError, requests.Timeout))
+    if status in THROTTLE_STATUSES:
+      return True
+    return method in IDEMPOTENT and status in RETRY_STATUSES
+
+  def delay(self, attempt, response=None):
+    '''Seconds to wait before retry attempt, counted from 1, at least the response's Retry-After'''
+    # Jittered, so the workers and forks refused together do not retry together
+    backoff = min(BACKOFF * 2 ** (attempt - 1), BACKOFF_MAX) * random.uniform(0.5, 1.0)
+    if response is None:
+      return backoff
+    return max(backoff, retry_after(response))
+
+  def record(self, seconds, retried=False, throttled=False, waited=0.0):
+    '''Add one request to the timing'''
+    with self._lock:
+      self._stats['calls'] += 1
+      self._stats['seconds'] += seconds
+      self._stats['slowest'] = max(self._stats['slowest'], seconds)
+      self._stats['waited'] += waited
+      if retried:
+        self._stats['retries'] += 1
+      if throttled:
+        self._stats['throttled'] += 1
+
+  def stats(self):
+    '''Requests made, retried and throttled, their time and the time waiting for the rate limit, in seconds'''
+    with self._lock:
+      stats = dict(self._stats)
+    for name in ('seconds', 'slowest', 'waited'):
+      stats[name] = round(stats[name], 3)
+    if self.limiter is not None:
+      stats['rate'] = round(self.limiter.rate(), 2)
+    return stats
+
+  def request(self, send, method, url, **kwargs):
+    '''Send one request through send, the session's own request, retrying as allowed'''
+    method = method.upper()
+    kwargs['timeout'] = self.timeout
+    attempt = 0
+    while True:
+      waited = self.limiter.acquire() if self.limiter is not None else 0.0
+      start = time.time()
+      try:
+        response = send(method, url, **kwargs)
+      except Exception as e:
+        self.record(time.time() - start, attempt > 0, waited=waited)
+        if attempt >= self.retries or not self.retryable(method, error=e):
+          raise
+        attempt += 1
+        time.sleep(self.delay(attempt))
+        continue
+
+      status = response.status_code
+      throttled = status in THROTTLE_STATUSES
+      self.record(time.time() - start, attempt > 0, throttled, waited)
+      if self.limiter is not None:
+        if throttled:
+          self.limiter.throttled(retry_after(response))
+        elif status < 500:
+          self.limiter.success()
+
+      if attempt >= self.retries or not self.retryable(method, status=status):
+        return response
+      response.close()
+      attempt += 1
+      time.sleep(self.delay(attempt, response))
+
+  def attach(self, session):
+    '''Route every request of a requests session, get, post and the rest, through this policy'''
+    send = session.request
+    session.request = lambda method, url, **kwargs: self.request(send, method, url, **kwargs)
+    return session
+
+class ThreadResource(object):
+  '''A pysnow resource per thread
+
+  pysnow copies a resource's parameters shallowly for each request, so
+  concurrent requests through one resource overwrite each other's query,
+  limit and offset: query slices lose or repeat tickets, groups get each
+  other's results and update(query=...) can PUT to another ticket than the
+  one it looked up. Threads share the client's session and connection
+  pool, never a resource.
+  '''
+
+  def __init__(self, client, api_path):
+    '''The constructor'''
+    self._client = client
+    self._api_path = api_path
+    self._local = threading.local()
+
+  def __getattr__(self, name):
+    '''The attribute of this thread's resource'''
+    resource = getattr(self._local, 'resource', None)
+    if resource is None:
+      resource = self._local.resource = self._client.resource(api_path=self._api_path)
+    return getattr(resource, name)
+
+class SnowClient(object):
+  '''pysnow client built from a module's CLIENT_FIELDS, with the defaults every module uses'''
+
+  def __init__(self, params, workers=1, input_display_value=False):
+    '''The constructor; nothing is imported or connected until the client is used'''
+    self._params = params
+    self._workers = max(workers, 1)
+    self._input_display_value = input_display_value
+    self._client = None
+    self._lock = threading.Lock()
+    limiter = RateLimiter(params['host'], params.get('rate_limit') or 0, params.get('rate_file'))
+    self.policy = RequestPolicy(params.get('timeout', 60), params.get('retries', 3), limiter)
+
+  @property
+  def client(self):
+    '''The pysnow client, created on first use, by one thread when several get there at once'''
+    with self._lock:
+      if self._client is None:
+        self._client = self._create()
+    return self._client
+
+  def _create(self):
+    '''A new pysnow client with the session set up'''
+    import pysnow
+    from ansible.module_utils.snow_broker import session_adapter
+
+    params = self._params
+    c = pysnow.Client(host=params['host'], user=params['user'], password=params['password'],
+      use_ssl=params.get('use_ssl', True))
+    c.parameters.display_value = True
+    c.parameters.exclude_reference_link = True
+    if self._input_display_value:
+      c.parameters.add_custom({'sysparm_input_display_value': True})
+
+    # Keep one pooled keep-alive connection per worker, through the broker if it is running
+    adapter = session_adapter(params, self._workers)
+    c.session.mount('https://', adapter)
+    c.session.mount('http://', adapter)
+    self.policy.attach(c.session)
+    return c
+
+  @property
+  def session(self):
+    '''The client's requests session'''
+    return self.client.session
+
+  @property
+  def base_url(self):
+    '''https://host, or http:// without use_ssl'''
+    return self.client.base_url
+
+  def resource(self, api_path):
+    '''A pysnow resource safe to share between threads, for example /table/incident'''
+    return ThreadResource(self.client, api_path)
+
+  def stats(self):
+    '''Requests made so far, see RequestPolicy.stats'''
+    return self.policy.stats()
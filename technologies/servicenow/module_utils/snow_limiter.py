@@ -0,0 +1,170 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Request rate to one ServiceNow instance, shared by every module process on the controller
+
+A token bucket per instance lives in a JSON file, read and written under an
+exclusive lock, so the forks of a play draw from the same bucket. The rate
+adapts: halved when the instance throttles (429, or 503 when it is busy) and
+raised by one request per second for each second of successful requests, so
+it settles just under the instance's limit. A throttled response's
+Retry-After pauses every process, not only the one that got it.
+'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+# Where the buckets are kept unless rate_file says otherwise
+DEFAULT_PATH = '~/.ansible/snow_limiter.json'
+
+# Multiplicative decrease on a throttle, additive increase in requests/s per second
+DECREASE = 0.5
+INCREASE = 1.0
+# Lowest adapted rate, requests per second
+MIN_RATE = 0.5
+# Throttles within this many seconds of a decrease belong to the same episode
+HOLD = 2.0
+# Seconds over which the request rate is measured, for the first decrease
+WINDOW = 5.0
+# A bucket unused this many seconds starts over, the instance's load has changed since
+IDLE = 300
+
+class RateLimiter(object):
+  '''Token bucket of one instance, kept in a file shared by concurrent processes
+
+  rate is the starting and highest rate in requests per second; 0 starts
+  unlimited, and after the first throttle adapts without a ceiling.
+  '''
+
+  def __init__(self, key, rate=0, path=None):
+    '''The constructor'''
+    self._key = key
+    self._ceiling = max(rate or 0, 0)
+    self._path = os.path.abspath(os.path.expanduser(path or DEFAULT_PATH))
+    self._memory = None
+    self._lock = threading.Lock()
+    self._successes = 0
+
+  def _initial(self, now):
+    '''Bucket of an instance not seen before'''
+    return { 'rate' : self._ceiling, 'tokens' : max(self._ceiling, 1), 'stamp' : now,
+      'blocked' : 0, 'decreased' : 0, 'recent' : 0, 'seen' : now }
+
+  def _bucket(self, buckets, now):
+    '''This instance's bucket in buckets, new or started over when idle'''
+    bucket = buckets.get(self._key)
+    if bucket is None or now - bucket['seen'] > IDLE:
+      bucket = buckets[self._key] = self._initial(now)
+    return bucket
+
+  def _update(self, change):
+    '''Apply change(bucket, now) to this instance's bucket under the lock, returns its result'''
+    if self._memory is None:
+      try:
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+          os.makedirs(directory)
+        f = open(self._path, 'a+')
+      except (IOError, OSError):
+        # Not shareable, limit this process only
+        self._memory = {}
+      else:
+        try:
+          fcntl.flock(f, fcntl.LOCK_EX)
+          f.seek(0)
+          try:
+            buckets = json.loads(f.read() or '{}')
+          except ValueError:
+            buckets = {}
+          now = time.time()
+          result = change(self._bucket(buckets, now), now)
+          f.seek(0)
+          f.truncate()
+          f.write(json.dumps(buckets))
+          return result
+        finally:
+          f.close()
+
+    with self._lock:
+      now = time.time()
+      return change(self._bucket(self._memory, now), now)
+
+  def _successful(self):
+    '''Successes since the last request, reset'''
+    with self._lock:
+      successes, self._successes = self._successes, 0
+    return successes
+
+  def acquire(self):
+    '''Wait for a token, and for any Retry-After pause in progress'''
+    successes = self._successful()
+
+    def take(bucket, now):
+      '''Reserve a token, returns the seconds to wait for it'''
+      # Additive increase, about INCREASE requests/s per second of successes
+      for i in range(successes):
+        if bucket['rate'] > 0:
+          bucket['rate'] += INCREASE / bucket['rate']
+      if self._ceiling and bucket['rate'] > self._ceiling:
+        bucket['rate'] = self._ceiling
+
+      bucket['recent'] = bucket['recent'] * math.exp(-(now - bucket['seen']) / WINDOW) + 1
+      bucket['seen'] = now
+      wait = max(bucket['blocked'] - now, 0)
+      rate = bucket['rate']
+      if rate > 0:
+        bucket['tokens'] = min(bucket['tokens'] + (now - bucket['stamp']) * rate, max(rate, 1)) - 1
+        if bucket['tokens'] < 0:
+          wait = max(wait, -bucket['tokens'] / rate)
+      bucket['stamp'] = now
+      return wait
+
+    wait = self._update(take)
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+  def success(self):
+    '''Count a request the instance served, applied at the next acquire'''
+    with self._lock:
+      self._successes += 1
+
+  def throttled(self, retry_after=0):
+    '''The instance refused a request as over its limit'''
+    def decrease(bucket, now):
+      '''Halve the rate once per episode, pause everyone for retry_after'''
+      if now - bucket['decreased'] >= HOLD:
+        measured = bucket['recent'] / WINDOW
+        base = bucket['rate'] or measured
+        bucket['rate'] = max(base * DECREASE, MIN_RATE)
+        bucket['tokens'] = min(bucket['tokens'], 0)
+        bucket['decreased'] = now
+      bucket['blocked'] = max(bucket['blocked'], now + retry_after)
+      return bucket['rate']
+
+    self._successful()
+    return self._update(decrease)
+
+  def rate(self):
+    '''Current rate in requests per second, 0 for unlimited'''
+    return self._update(lambda bucket, now: bucket['rate'])
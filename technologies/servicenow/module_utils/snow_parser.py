@@ -0,0 +1,167 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Work out remediation details from ticket descriptions, by ticket format rules
+
+A rule applies to descriptions containing its match text; the first rule that
+applies sets the details:
+
+  name:    label for error messages
+  match:   text the description must contain
+  set:     detail: constant value
+  keys:    detail: Key, read from the Key=Value~ fields of the description
+  pattern: regular expression, each named group sets the detail of that name
+
+Details a rule does not set are ''. Rules from a file, YAML or JSON holding a
+list of rules, are tried before the built-in ones.
+'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+
+DETAILS = ('service_name', 'remediation', 'escalation_group')
+
+# Descriptions we know, in the order they are tried
+DEFAULT_RULES = [
+  # Windows ntservices incidents
+  {
+    'name' : 'ntservices',
+    'match' : 'ntservices',
+    'pattern' : r'ntservices:(?P<service_name>.+) -',
+    'set' : { 'remediation' : 'demo_service_restart', 'escalation_group' : 'Wintel Support' },
+  },
+  # Demo tickets, as created by snow_create_ticket
+  {
+    'name' : 'demo',
+    'match' : '~EscalationGroup=',
+    'set' : { 'service_name' : 'demoService' },
+    'keys' : { 'remediation' : 'Remediation', 'escalation_group' : 'EscalationGroup' },
+  },
+  # Any other Key=Value~ description naming its remediation
+  {
+    'name' : 'fields',
+    'match' : 'Remediation=',
+    'keys' : {
+      'service_name' : 'ServiceName',
+      'remediation' : 'Remediation',
+      'escalation_group' : 'EscalationGroup',
+    },
+  },
+]
+
+class RuleError(Exception):
+  '''A rule, or the file holding it, is invalid'''
+  pass
+
+def split_fields(desc):
+  '''All Key=Value fields of a ~ separated description, in one pass'''
+  fields = {}
+  for piece in desc.split('~'):
+    key, sep, value = piece.partition('=')
+    if sep:
+      fields[key.strip()] = value
+  return fields
+
+class Rule(object):
+  '''One compiled ticket format rule'''
+
+  def __init__(self, spec):
+    '''The constructor'''
+    if not isinstance(spec, dict) or not spec.get('match'):
+      raise RuleError("Rule without match text: ({0})".format(spec))
+    self.name = spec.get('name', spec['match'])
+    self.match = spec['match']
+    self.values = dict(spec.get('set') or {})
+    self.keys = dict(spec.get('keys') or {})
+    self.pattern = None
+    try:
+      if spec.get('pattern'):
+        self.pattern = re.compile(spec['pattern'])
+    except re.error as e:
+      raise RuleError("Rule {0} has an invalid pattern ({1})".format(self.name, e))
+
+    unknown = set(self.values) | set(self.keys)
+    if self.pattern:
+      unknown |= set(self.pattern.groupindex)
+    unknown -= set(DETAILS)
+    if unknown:
+      raise RuleError("Rule {0} sets unknown details: ({1})".format(self.name, ', '.join(sorted(unknown))))
+
+  def apply(self, desc):
+    '''Details of a description this rule matches'''
+    details = dict.fromkeys(DETAILS, '')
+    details.update(self.values)
+
+    if self.keys:
+      fields = split_fields(desc)
+      for detail, key in self.keys.items():
+        details[detail] = fields.get(key, '')
+
+    if self.pattern:
+      found = self.pattern.search(desc)
+      for detail in self.pattern.groupindex:
+        details[detail] = (found.group(detail) or '') if found else ''
+
+    return details
+
+class Parser(object):
+  '''Rules compiled once, then applied to any number of descriptions'''
+
+  def __init__(self, specs=None):
+    '''The constructor'''
+    self._rules = [ Rule(s) for s in (DEFAULT_RULES if specs is None else specs) ]
+
+  def register(self, spec, first=True):
+    '''Add a rule, tried before the existing ones unless first is False'''
+    rule = Rule(spec)
+    if first:
+      self._rules.insert(0, rule)
+    else:
+      self._rules.append(rule)
+
+  def load(self, path):
+    '''Register the rules of a YAML or JSON file, ahead of the existing ones'''
+    import yaml
+    try:
+      with open(path) as f:
+        specs = yaml.safe_load(f)
+    except (IOError, OSError) as e:
+      raise RuleError("Unable to read rules file ({0})".format(e))
+    except yaml.YAMLError as e:
+      raise RuleError("Unable to parse rules file {0} ({1})".format(path, e))
+
+    if not isinstance(specs, list):
+      raise RuleError("Rules file {0} must hold a list of rules".format(path))
+    for spec in reversed(specs):
+      self.register(spec)
+
+  def parse(self, desc):
+    '''Details of one description, all '' when no rule applies'''
+    desc = desc or ''
+    for rule in self._rules:
+      if rule.match in desc:
+        return rule.apply(desc)
+
+    return dict.fromkeys(DETAILS, '')
+
+# Built-in rules, compiled at import
+DEFAULT_PARSER = Parser()
+
+def parse_description(desc):
+  '''Details of one description using the built-in rules'''
+  return DEFAULT_PARSER.parse(desc)
@@ -0,0 +1,143 @@
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+'''Keep small JSON documents between module runs, in a file or the pglook database'''
+
+# python 3 headers, required if submitting to Ansible
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+
+# Module options selecting the store, merged into a module's argument_spec
+STATE_FIELDS = {
+  "state_backend" : { "required": False, "type": "str", "default": "file",
+    "choices": ["file", "postgres"] },
+  "state_path" : { "required": False, "type": "str", "default": "~/.ansible/snow_state.json" },
+  "state_dbname" : { "required": False, "type": "str", "default": "persist" },
+  "state_user" : { "required": False, "type": "str", "default": "persist" },
+  "state_host" : { "required": False, "type": "str", "default": "127.0.0.1" },
+  "state_password" : { "required": False, "type": "str", "no_log": True },
+}
+
+class StateError(Exception):
+  '''The state store could not be read or written'''
+  pass
+
+class FileState(object):
+  '''All keys in one JSON file, replaced atomically under a lock'''
+
+  def __init__(self, path):
+    '''The constructor'''
+    self._path = os.path.abspath(os.path.expanduser(path))
+
+  def _lock(self):
+    '''Open and lock the companion lock file, returns it'''
+    try:
+      directory = os.path.dirname(self._path)
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      lock = open(self._path + '.lock', 'a')
+      fcntl.flock(lock, fcntl.LOCK_EX)
+    except (IOError, OSError) as e:
+      raise StateError("Unable to lock state file ({0})".format(e))
+    return lock
+
+  def _read(self):
+    '''Every key in the file'''
+    try:
+      with open(self._path) as f:
+        return json.load(f)
+    except (IOError, OSError) as e:
+      if errno.ENOENT == e.errno:
+        return {}
+      raise StateError("Unable to read state file ({0})".format(e))
+    except ValueError as e:
+      raise StateError("Corrupt state file {0} ({1})".format(self._path, e))
+
+  def load(self, key):
+    '''Value of key, None when it was never saved'''
+    lock = self._lock()
+    try:
+      return self._read().get(key)
+    finally:
+      lock.close()
+
+  def save(self, key, value):
+    '''Replace the value of key'''
+    lock = self._lock()
+    try:
+      data = self._read()
+      data[key] = value
+      fd, temp = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix='.snow_state')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+      os.rename(temp, self._path)
+    except (IOError, OSError) as e:
+      raise StateError("Unable to write state file ({0})".format(e))
+    finally:
+      lock.close()
+
+class PostgresState(object):
+  '''Keys in the pglook tower table, through tower_reader and tower_writer'''
+
+  def __init__(self, dbname, user, host, password):
+    '''The constructor'''
+    self._dsn = "dbname='{0}' user='{1}' host='{2}' password='{3}'".format(
+      dbname, user, host, password)
+
+  def _run(self, statement, params, fetch=False):
+    '''Run one statement in its own connection'''
+    # Only the postgres backend needs the driver, import it when it is used
+    try:
+      import psycopg2
+    except ImportError:
+      raise StateError("The postgres state backend requires psycopg2")
+    try:
+      conn = psycopg2.connect(self._dsn)
+      try:
+        cur = conn.cursor()
+        cur.execute(statement, params)
+        row = cur.fetchone() if fetch else None
+        conn.commit()
+        return row
+      finally:
+        conn.close()
+    except psycopg2.Error as e:
+      raise StateError("State database failure ({0})".format(e))
+
+  def load(self, key):
+    '''Value of key, None when it was never saved'''
+    row = self._run("SELECT * FROM tower_reader(%(name)s)", { 'name' : key }, fetch=True)
+    return row[0] if row else None
+
+  def save(self, key, value):
+    '''Replace the value of key'''
+    self._run("SELECT * FROM tower_writer(%(name)s, %(jdata)s::jsonb)",
+      { 'name' : key, 'jdata' : json.dumps(value) })
+
+def open_state(params):
+  '''The store selected by a module's STATE_FIELDS options'''
+  if 'postgres' == params['state_backend']:
+    if not params['state_password']:
+      raise StateError("state_password is required for the postgres state backend")
+    return PostgresState(params['state_dbname'], params['state_user'],
+      params['state_host'], params['state_password'])
+
+  return FileState(params['state_path'])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+''' Local connection broker for the snow_* modules.
+
+Holds a keep-alive session per ServiceNow instance and credential, and relays the
+modules' requests to it from a Unix socket, so module runs with connection: local
+reuse connections instead of opening a new TLS session each time.
+'''
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import requests
+
+try:
+  from http.server import BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn, UnixStreamServer
+  from urllib.parse import urlparse
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn, UnixStreamServer
+  from urlparse import urlparse
+
+# snow_broker (the module side) lives in ../module_utils
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils'))
+from snow_broker import HOP_HEADERS, running, socket_path
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+STATUS_PATH = '/broker/status'
+
+class Sessions(object):
+  '''One requests session per instance and credential, dropped once idle'''
+
+  def __init__(self, pool, idle):
+    '''The constructor'''
+    self._lock = threading.Lock()
+    self._sessions = {}
+    self._pool = pool
+    self._idle = idle
+    self.requests = 0
+    self.last = time.time()
+
+  def get(self, instance, authorization):
+    '''The session of an instance and credential, created on first use'''
+    key = (instance, authorization)
+    with self._lock:
+      self.requests += 1
+      self.last = time.time()
+      entry = self._sessions.get(key)
+      if entry is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._pool)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        entry = self._sessions[key] = { 'session' : session }
+      entry['used'] = self.last
+      return entry['session']
+
+  def reap(self):
+    '''Close the sessions idle for longer than idle seconds'''
+    now = time.time()
+    with self._lock:
+      for key, entry in list(self._sessions.items()):
+        if now - entry['used'] > self._idle:
+          entry['session'].close()
+          del self._sessions[key]
+
+  def status(self):
+    '''Counts for the status page'''
+    with self._lock:
+      return { 'sessions' : len(self._sessions), 'requests' : self.requests,
+        'idle' : int(time.time() - self.last) }
+
+class Handler(BaseHTTPRequestHandler):
+  '''Relay one request to its instance over the pooled session'''
+  protocol_version = 'HTTP/1.1'
+  sessions = None
+  timeout_seconds = 60
+
+  def log_message(self, format, *args):
+    '''Keep quiet'''
+    pass
+
+  def _reply(self, status, headers, data):
+    '''Send a response'''
+    self.send_response(status)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _relay(self):
+    '''Forward the request, named by its absolute URL, and send back the response'''
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else None
+
+    if STATUS_PATH == self.path:
+      data = json.dumps(self.sessions.status()).encode('utf-8')
+      return self._reply(200, [ ('Content-Type', 'application/json') ], data)
+
+    url = urlparse(self.path)
+    if url.scheme not in ('http', 'https') or not url.netloc:
+      data = json.dumps({ 'error' : { 'message' : 'Absolute http(s) URL expected' } }).encode('utf-8')
+      return self._reply(400, [ ('Content-Type', 'application/json') ], data)
+
+    headers = dict((k, v) for k, v in self.headers.items()
+      if k.lower() not in HOP_HEADERS + ('host', 'content-length'))
+    session = self.sessions.get("{0}://{1}".format(url.scheme, url.netloc), headers.get('Authorization'))
+    try:
+      response = session.request(self.command, self.path, headers=headers, data=body,
+        allow_redirects=False, timeout=self.timeout_seconds)
+    except requests.RequestException as e:
+      data = json.dumps({ 'error' : { 'message' : "Broker relay failure ({0})".format(e) } }).encode('utf-8')
+      return self._reply(502, [ ('Content-Type', 'application/json') ], data)
+
+    self._reply(response.status_code,
+      [ (k, v) for k, v in response.headers.items() if k.lower() not in HOP_HEADERS + ('content-length',) ],
+      response.content)
+
+  do_GET = _relay
+  do_POST = _relay
+  do_PUT = _relay
+  do_PATCH = _relay
+  do_DELETE = _relay
+
+class Server(ThreadingMixIn, UnixStreamServer):
+  '''One thread per module connection'''
+  daemon_threads = True
+
+def make_server(path, pool=20, idle=900, timeout=60):
+  '''Broker listening on the Unix socket path, readable by this user only'''
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory, 0o700)
+  if os.path.exists(path):
+    if running(path):
+      raise RuntimeError("A broker is already listening on {0}".format(path))
+    os.remove(path)
+
+  sessions = Sessions(pool, idle)
+  handler = type('BoundHandler', (Handler,), { 'sessions' : sessions, 'timeout_seconds' : timeout })
+  umask = os.umask(0o177)
+  try:
+    server = Server(path, handler)
+  finally:
+    os.umask(umask)
+  server.sessions = sessions
+  return server
+
+def watch(server, interval, exit_after):
+  '''Drop idle sessions, and stop the broker after exit_after idle seconds when set'''
+  while True:
+    time.sleep(interval)
+    server.sessions.reap()
+    if exit_after and time.time() - server.sessions.last > exit_after:
+      server.shutdown()
+      return
+
+def main():
+  '''Script entry point'''
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--socket', default=None, help='Unix socket, by default $SNOW_BROKER_SOCKET or ~/.ansible/snow_broker.sock')
+  parser.add_argument('--pool', type=int, default=20, help='connections kept per instance and credential')
+  parser.add_argument('--idle', type=int, default=900, help='seconds before an unused session is closed')
+  parser.add_argument('--timeout', type=int, default=60, help='seconds to wait for the instance')
+  parser.add_argument('--exit-after', type=int, default=0, help='stop after this many idle seconds, 0 to run until stopped')
+  args = parser.parse_args()
+
+  path = socket_path(args.socket)
+  try:
+    server = make_server(path, args.pool, args.idle, args.timeout)
+  except (RuntimeError, OSError) as e:
+    sys.stderr.write("{0}\n".format(e))
+    return EXIT_FAILURE
+
+  watcher = threading.Thread(target=watch, args=(server, min(60, max(args.idle, 1)), args.exit_after))
+  watcher.daemon = True
+  watcher.start()
+
+  sys.stderr.write("Brokering on {0}\n".format(path))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if os.path.exists(path):
+      os.remove(path)
+
+  return EXIT_SUCCESS
+
+if __name__ == '__main__':
+  sys.exit(main())
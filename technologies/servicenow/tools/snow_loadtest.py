@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+''' Load test the snow_* pipeline end to end against the local simulator.
+
+Seeds the simulator with open tickets, then runs a playbook that creates more,
+polls, processes and remediates them (cancel, WIP, resolve or transfer), and
+reports tickets per second and API calls per ticket.
+'''
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import snow_brokerd
+import snow_simulator
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+# The playbook directory, holding library, module_utils and action_plugins
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PLAYBOOK = '''---
+- hosts: localhost
+  connection: local
+  gather_facts: no
+  vars:
+    snow: &snow
+      host: "{host}"
+      user: loadtest
+      password: loadtest
+      use_ssl: false
+      rate_file: "{rate_file}"
+  tasks:
+    - name: Create tickets
+      snow_create_ticket:
+        <<: *snow
+        assigned_to: "Ansible, User"
+        assignment_group: "{group}"
+        escalation_group: "SERVICE DESK"
+        requestor: "Ansible, User"
+        tickets: "{{{{ lookup('file', '{tickets}') | from_json }}}}"
+        workers: {workers}
+        batch_size: {batch_size}
+      when: {create} > 0
+      ignore_errors: true
+
+    - name: Poll tickets
+      snow_query_tickets:
+        <<: *snow
+        minutes: 1440
+        group: "{group}"
+        slices: 0
+        workers: {workers}
+      register: polled
+
+    - name: Process tickets
+      snow_ticket_processor:
+        tickets: "{{{{ polled.meta | from_json }}}}"
+        host: null
+      register: processed
+
+    - name: Cancel duplicates
+      snow_update_ticket:
+        <<: *snow
+        tickets: "{{{{ processed.meta.cancel }}}}"
+        action: cancel
+        notes: "Ansible cancelation of duplicate ticket"
+        workers: {workers}
+        batch_size: {batch_size}
+      when: processed.meta.cancel | length > 0
+      ignore_errors: true
+
+    - name: Remediate
+      snow_remediate:
+        <<: *snow
+        tickets: "{{{{ processed.meta.active }}}}"
+        remediation: "{{{{ item }}}}"
+        workers: {workers}
+        batch_size: {batch_size}
+      loop: [ complex, grouped ]
+      register: remediated
+
+    - name: Save counts
+      copy:
+        dest: "{counts}"
+        content: "{{{{ {{
+          'polled' : polled.meta | from_json | length,
+          'active' : processed.meta.active | length,
+          'cancelled' : processed.meta.cancel | length,
+          'resolved' : remediated.results | map(attribute='success') | map('length') | sum,
+          'transferred' : remediated.results | map(attribute='failure') | map('length') | sum
+        }} | to_json }}}}"
+'''
+
+def playbook_command(args):
+  '''ansible-playbook, from the same environment as this interpreter by default'''
+  if args.ansible_playbook:
+    return args.ansible_playbook
+  local = os.path.join(os.path.dirname(sys.executable), 'ansible-playbook')
+  return local if os.path.exists(local) else 'ansible-playbook'
+
+def main():
+  '''Script entry point'''
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--tickets', type=int, default=1000, help='open tickets seeded before the run')
+  parser.add_argument('--create', type=int, default=100, help='tickets created by the playbook')
+  parser.add_argument('--servers', type=int, default=200, help='cmdb_ci_server records, spread over the tickets')
+  parser.add_argument('--group', default='ANSIBLE')
+  parser.add_argument('--workers', type=int, default=10)
+  parser.add_argument('--batch-size', type=int, default=0, help='use the batch API, this many requests per call')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API calls that fail')
+  parser.add_argument('--rate-limit', type=float, default=0, help='API calls per second the simulator serves')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--broker', action='store_true', help='relay the modules through snow_brokerd')
+  parser.add_argument('--ansible-playbook', default=None, help='ansible-playbook to run')
+  parser.add_argument('--keep', action='store_true', help='keep the work directory')
+  args = parser.parse_args()
+
+  simulator = snow_simulator.Simulator(latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+    rate_limit=args.rate_limit)
+  snow_simulator.seed(simulator.store, args.tickets, args.servers, args.group, seed=args.seed)
+  server, simulator = snow_simulator.start(simulator)
+  simulator.reset_calls()
+
+  work = tempfile.mkdtemp(prefix='snow_loadtest')
+  tickets = os.path.join(work, 'tickets.json')
+  counts = os.path.join(work, 'counts.json')
+  playbook = os.path.join(work, 'loadtest.yml')
+  with open(tickets, 'w') as f:
+    json.dump([ {
+        'short_description' : "Load test ticket {0}".format(i),
+        'remediation' : ('complex', 'grouped')[i % 2],
+        'server' : "server{0:05d}.example.com".format(i % max(args.servers, 1)),
+        'serviceName' : "service{0}".format(i % 10),
+      } for i in range(args.create) ], f)
+  with open(playbook, 'w') as f:
+    f.write(PLAYBOOK.format(host="{0}:{1}".format(*server.server_address), group=args.group,
+      tickets=tickets, counts=counts, rate_file=os.path.join(work, 'limiter.json'), create=args.create, workers=args.workers, batch_size=args.batch_size))
+
+  broker = None
+  if args.broker:
+    broker = snow_brokerd.make_server(os.path.join(work, 'broker.sock'), pool=args.workers)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  env = dict(os.environ,
+    ANSIBLE_LIBRARY=os.path.join(TOP, 'library'),
+    ANSIBLE_MODULE_UTILS=os.path.join(TOP, 'module_utils'),
+    ANSIBLE_ACTION_PLUGINS=os.path.join(TOP, 'action_plugins'),
+    ANSIBLE_LOCALHOST_WARNING='false',
+    ANSIBLE_INVENTORY_UNPARSED_WARNING='false')
+  if broker is not None:
+    env['SNOW_BROKER_SOCKET'] = os.path.join(work, 'broker.sock')
+  else:
+    env.pop('SNOW_BROKER_SOCKET', None)
+  command = [ playbook_command(args), '-i', 'localhost,', '-e', "ansible_python_interpreter={0}".format(sys.executable), playbook ]
+
+  start = time.time()
+  run = subprocess.call(command, env=env, stdout=open(os.path.join(work, 'ansible.log'), 'w'), stderr=subprocess.STDOUT)
+  elapsed = time.time() - start
+  server.shutdown()
+  if broker is not None:
+    broker.shutdown()
+    broker.server_close()
+
+  if run != 0 or not os.path.exists(counts):
+    sys.stderr.write("Playbook failed, see {0}\n".format(os.path.join(work, 'ansible.log')))
+    return EXIT_FAILURE
+
+  with open(counts) as f:
+    result = json.load(f)
+  calls = simulator.calls()
+  total = sum(n for name, n in calls.items() if name not in ('errors', 'throttled') and not name.startswith('batched'))
+  handled = max(result['polled'], 1)
+
+  print("tickets\t{0} seeded, {1} created, {2} polled".format(args.tickets, args.create, result['polled']))
+  print("outcome\t{0} active, {1} cancelled, {2} resolved, {3} transferred".format(
+    result['active'], result['cancelled'], result['resolved'], result['transferred']))
+  print("elapsed\t{0:.2f}s".format(elapsed))
+  print("rate\t{0:.1f} tickets/s".format(handled / elapsed))
+  print("calls\t{0} ({1:.2f} per ticket), {2} injected errors, {3} throttled".format(
+    total, float(total) / handled, calls.get('errors', 0), calls.get('throttled', 0)))
+  for name in sorted(calls):
+    if name not in ('errors', 'throttled'):
+      print("\t{0}\t{1}".format(name, calls[name]))
+
+  if args.keep:
+    print("work\t{0}".format(work))
+  else:
+    shutil.rmtree(work)
+
+  return EXIT_SUCCESS
+
+if __name__ == '__main__':
+  sys.exit(main())
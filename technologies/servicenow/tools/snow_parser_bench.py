@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+''' Benchmark the ticket description parser against the per-ticket regex version it replaced.
+'''
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+# snow_parser lives in ../module_utils
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils'))
+import snow_parser
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+def legacy_parse(desc):
+  '''snow_query_tickets.parse_description before the rule engine, for comparison'''
+  description_details = {'service_name':'', 'remediation':'', 'escalation_group':''}
+
+  win_service_match = re.compile('ntservices').search(desc)
+  demo_match = re.compile('~EscalationGroup=').search(desc)
+
+  if win_service_match:
+    description_details['remediation'] = 'demo_service_restart'
+    description_details['escalation_group'] = 'Wintel Support'
+    service_match = re.compile('(?<=ntservices:).+(?= -)').search(desc)
+    description_details['service_name'] = service_match.group() if service_match else ''
+  elif demo_match:
+    description_details['service_name'] = 'demoService'
+    remediation_match = re.compile('(?<=Remediation=).+?(?=~)').search(desc)
+    description_details['remediation'] = remediation_match.group() if remediation_match else ''
+    escalation_match = re.compile('(?<=EscalationGroup=).+?(?=~)').search(desc)
+    description_details['escalation_group'] = escalation_match.group() if escalation_match else ''
+
+  return description_details
+
+def make_corpus(count, seed):
+  '''count synthetic descriptions in a mix of the known formats'''
+  rng = random.Random(seed)
+  corpus = []
+  for i in range(count):
+    kind = rng.random()
+    if kind < 0.4:
+      corpus.append("Server=host{0}.example.com~Remediation={1}~ServiceName=svc{2}~EscalationGroup=SERVICE DESK".format(
+        i, rng.choice(['complex', 'grouped']), rng.randint(0, 99)))
+    elif kind < 0.7:
+      corpus.append("ALERT host{0}: ntservices:Spooler{1} - service stopped, restart failed".format(i, rng.randint(0, 9)))
+    else:
+      corpus.append("Disk usage {0}% on /var of host{1}, please investigate. ".format(rng.randint(80, 99), i) * 3)
+  return corpus
+
+def run(name, parse, corpus, iterations):
+  '''Best of iterations runs over the corpus, returns descriptions per second'''
+  best = None
+  for _ in range(iterations):
+    start = time.time()
+    for desc in corpus:
+      parse(desc)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  rate = len(corpus) / best
+  print("{0}\t{1:.3f}s\t{2:.0f}/s".format(name, best, rate))
+  return rate
+
+def main():
+  '''Script entry point'''
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--count', type=int, default=100000, help='descriptions in the corpus')
+  parser.add_argument('--iterations', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--rules', default=None, help='rules file to load ahead of the built-in rules')
+  args = parser.parse_args()
+
+  corpus = make_corpus(args.count, args.seed)
+  rules = snow_parser.Parser()
+  if args.rules:
+    rules.load(args.rules)
+
+  print("parser\tbest\trate")
+  legacy = run('legacy', legacy_parse, corpus, args.iterations)
+  current = run('rules', rules.parse, corpus, args.iterations)
+  print("speedup\t{0:.2f}x".format(current / legacy))
+
+  return EXIT_SUCCESS
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+''' Local stand-in for the parts of the ServiceNow REST API used by the snow_* modules.
+'''
+################################################################################
+#   Copyright (C) 2018 Andrew Gold
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+################################################################################
+import re
+import sys
+import json
+import time
+import uuid
+import base64
+import math
+import random
+import argparse
+import threading
+
+from collections import Counter
+from datetime import datetime
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlparse, parse_qs, urlencode
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlparse, parse_qs
+  from urllib import urlencode
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+TABLE_PREFIX = '/api/now/table/'
+STATS_PREFIX = '/api/now/stats/'
+BATCH_PATH = '/api/now/v1/batch'
+CALLS_PATH = '/simulator/calls'
+
+# Times as displayed in the default date format
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Field values of a new incident, as the instance would default them
+INCIDENT_DEFAULTS = {
+  'state' : '1',
+  'incident_state' : '1',
+  'active' : 'true',
+  'priority' : '5 - Planning',
+}
+
+class Store(object):
+  '''In memory tables of records keyed by sys_id'''
+
+  def __init__(self):
+    '''The constructor'''
+    self._lock = threading.Lock()
+    self._tables = {}
+    self._numbers = 0
+
+  def _table(self, name):
+    '''Records of one table'''
+    return self._tables.setdefault(name, {})
+
+  def insert(self, table, record):
+    '''Add a record, filling in sys_id, number, timestamps and incident defaults'''
+    now = datetime.today().strftime(TIME_FORMAT)
+    with self._lock:
+      record = dict(record)
+      record.setdefault('sys_id', uuid.uuid4().hex)
+      record.setdefault('sys_created_on', now)
+      record.setdefault('sys_updated_on', record['sys_created_on'])
+      if 'incident' == table:
+        for field, value in INCIDENT_DEFAULTS.items():
+          record.setdefault(field, value)
+        record.setdefault('opened_at', record['sys_created_on'])
+      if 'incident' == table and not record.get('number'):
+        self._numbers += 1
+        record['number'] = "INC{0:07d}".format(self._numbers)
+      elif 'incident' == table and record['number'][3:].isdigit():
+        # Keep generated numbers clear of seeded ones
+        self._numbers = max(self._numbers, int(record['number'][3:]))
+      self._table(table)[record['sys_id']] = record
+      return dict(record)
+
+  def update(self, table, sys_id, payload):
+    '''Change fields of a record, None when it does not exist'''
+    with self._lock:
+      record = self._table(table).get(sys_id)
+      if record is None:
+        return None
+      record.update(payload)
+      record['sys_updated_on'] = datetime.today().strftime(TIME_FORMAT)
+      return dict(record)
+
+  def delete(self, table, sys_id):
+    '''Remove a record, False when it does not exist'''
+    with self._lock:
+      return self._table(table).pop(sys_id, None) is not None
+
+  def get(self, table, sys_id):
+    '''One record or None'''
+    with self._lock:
+      record = self._table(table).get(sys_id)
+      return dict(record) if record else None
+
+  def select(self, table, query):
+    '''Records matching an encoded query, in its ORDERBY order'''
+    match = compile_query(query)
+    order = compile_order(query)
+    with self._lock:
+      records = [ dict(r) for r in self._table(table).values() if match(r) ]
+    for field, descending in reversed(order):
+      records.sort(key=lambda r: sortable(value_of(r, field)), reverse=descending)
+    return records
+
+  def count(self, table, query):
+    '''Number of records matching an encoded query'''
+    match = compile_query(query)
+    with self._lock:
+      return sum(1 for r in self._table(table).values() if match(r))
+
+# field, operator, operand of one condition; longer operators first
+CONDITION = re.compile(r'([\w.]+?)(ISNOTEMPTY|ISEMPTY|STARTSWITH|ENDSWITH|NOT LIKE|LIKE|NOT IN|IN|BETWEEN|!=|>=|<=|=|>|<)(.*)$')
+DATE_GENERATE = re.compile(r'javascript:gs\.dateGenerate\(([^)]*)\)')
+
+def value_of(record, field):
+  '''Value of a field as text; dot-walked references use the stored display value'''
+  if field not in record and '.' in field:
+    field = field.split('.', 1)[0]
+  value = record.get(field)
+  return '' if value is None else str(value)
+
+def sortable(text):
+  '''Numbers compare as numbers, anything else as text'''
+  try:
+    return (0, float(text), '')
+  except ValueError:
+    return (1, 0, text)
+
+def operand_value(text):
+  '''An operand, with javascript:gs.dateGenerate("date", "time") replaced by its time'''
+  return DATE_GENERATE.sub(
+    lambda m: ' '.join(a.strip().strip('\'"') for a in m.group(1).split(',')), text)
+
+def equal(value, operand):
+  '''= as the instance applies it; true and false match 1 and 0 in number fields'''
+  if value == operand:
+    return True
+  if operand in ('true', 'false') and value.isdigit():
+    return int(value) == (1 if 'true' == operand else 0)
+  return False
+
+def compare(value, operand):
+  '''-1, 0 or 1, numerically when both sides are numbers'''
+  a, b = sortable(value), sortable(operand)
+  return (a > b) - (a < b)
+
+def condition(term):
+  '''Predicate of one condition'''
+  found = CONDITION.match(term)
+  if not found:
+    raise ValueError("Unsupported query term ({0})".format(term))
+  field, operator, operand = found.groups()
+  operand = operand_value(operand)
+
+  tests = {
+    '=' : lambda v: equal(v, operand),
+    '!=' : lambda v: not equal(v, operand),
+    '>' : lambda v: compare(v, operand) > 0,
+    '>=' : lambda v: compare(v, operand) >= 0,
+    '<' : lambda v: compare(v, operand) < 0,
+    '<=' : lambda v: compare(v, operand) <= 0,
+    'IN' : lambda v: v in operand.split(','),
+    'NOT IN' : lambda v: v not in operand.split(','),
+    # The instance matches strings regardless of case
+    'STARTSWITH' : lambda v: v.lower().startswith(operand.lower()),
+    'ENDSWITH' : lambda v: v.lower().endswith(operand.lower()),
+    'LIKE' : lambda v: operand.lower() in v.lower(),
+    'NOT LIKE' : lambda v: operand.lower() not in v.lower(),
+    'ISEMPTY' : lambda v: '' == v,
+    'ISNOTEMPTY' : lambda v: '' != v,
+  }
+  if 'BETWEEN' == operator:
+    start, end = operand.split('@', 1)
+    test = lambda v: compare(v, start) >= 0 and compare(v, end) <= 0
+  else:
+    test = tests[operator]
+
+  return lambda record: test(value_of(record, field))
+
+def compile_query(query):
+  '''Predicate for a subset of the encoded query syntax
+
+  Conditions are joined with ^ (AND) and ^OR, which binds to the condition
+  before it; ^NQ starts another query whose results are added. ORDERBY
+  terms are left to compile_order.
+  '''
+  queries = []
+  for part in (query or '').split('^NQ'):
+    groups = []
+    for term in [ t for t in part.split('^') if t ]:
+      if term.startswith('ORDERBY'):
+        continue
+      if term.startswith('OR') and groups:
+        groups[-1].append(condition(term[2:]))
+      else:
+        groups.append([ condition(term) ])
+    queries.append(groups)
+
+  return lambda record: any(
+    all(any(test(record) for test in group) for group in groups) for groups in queries)
+
+def compile_order(query):
+  '''(field, descending) of each ORDERBY term, most significant first'''
+  order = []
+  for term in (query or '').split('^'):
+    if term.startswith('ORDERBYDESC'):
+      order.append((term[len('ORDERBYDESC'):], True))
+    elif term.startswith('ORDERBY'):
+      order.append((term[len('ORDERBY'):], False))
+  return order
+
+def project(record, fields):
+  '''Limit a record to sysparm_fields'''
+  if not fields:
+    return record
+  return dict((f, record.get(f, '')) for f in fields)
+
+class Simulator(object):
+  '''Dispatch table, stats and batch API calls against a Store
+
+  latency seconds are added to every call, and error_rate of the calls fail
+  with error_status and a Retry-After header, as a busy instance would.
+  Calls beyond rate_limit per second are refused with 429, as the instance's
+  rate limit rules do.
+  '''
+
+  def __init__(self, store=None, latency=0.0, error_rate=0.0, error_status=503, seed=None, rate_limit=0):
+    '''The constructor'''
+    self.store = store or Store()
+    self.latency = latency
+    self.error_rate = error_rate
+    self.error_status = error_status
+    self.rate_limit = rate_limit
+    self._tokens = rate_limit
+    self._stamp = time.time()
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self._calls = Counter()
+
+  def count_call(self, name):
+    '''Count one call under name'''
+    with self._lock:
+      self._calls[name] += 1
+
+  def calls(self):
+    '''Calls served so far, by method and table or API; requests inside batches are "batched"'''
+    with self._lock:
+      return dict(self._calls)
+
+  def reset_calls(self):
+    '''Start counting again'''
+    with self._lock:
+      self._calls.clear()
+
+  def admit(self):
+    '''Take a token of the rate limit, returns the seconds until one is available when there is none'''
+    now = time.time()
+    self._tokens = min(self._tokens + (now - self._stamp) * self.rate_limit, max(self.rate_limit, 1))
+    self._stamp = now
+    if self._tokens < 1:
+      return (1 - self._tokens) / self.rate_limit
+    self._tokens -= 1
+    return 0
+
+  def inject(self):
+    '''Delay a call, returns an error response for the calls chosen to fail or over the rate limit'''
+    if self.latency:
+      time.sleep(self.latency)
+    with self._lock:
+      wait = self.rate_limit and self.admit()
+      if wait:
+        self._calls['throttled'] += 1
+    if wait:
+      return 429, { 'error' : { 'message' : 'Rate limit exceeded' } }, { 'Retry-After' : str(int(math.ceil(wait))) }
+    with self._lock:
+      failed = self.error_rate and self._random.random() < self.error_rate
+      if failed:
+        self._calls['errors'] += 1
+    if failed:
+      return self.error_status, { 'error' : { 'message' : 'Injected failure' } }, { 'Retry-After' : '1' }
+    return None
+
+  def links(self, path, params, offset, limit, total):
+    '''Link header of a page, with first, prev, next and last as the instance sends them'''
+    def link(rel, at):
+      query = dict(params, sysparm_offset=str(at), sysparm_limit=str(limit))
+      return '<{0}?{1}>;rel="{2}"'.format(path, urlencode(sorted(query.items())), rel)
+
+    last = max((total - 1) // limit * limit, 0)
+    links = [ link('first', 0) ]
+    if offset > 0:
+      links.append(link('prev', max(offset - limit, 0)))
+    if offset + limit < total:
+      links.append(link('next', offset + limit))
+    links.append(link('last', last))
+    return ','.join(links)
+
+  def table(self, method, path, params, body, batched=False):
+    '''Handle one table API call, returns (status, body, headers)'''
+    parts = path[len(TABLE_PREFIX):].strip('/').split('/')
+    table = parts[0]
+    sys_id = parts[1] if len(parts) > 1 else None
+    fields = [ f for f in params.get('sysparm_fields', '').split(',') if f ]
+    self.count_call("{0}{1} {2}".format('batched ' if batched else '', method, table))
+
+    if 'GET' == method and sys_id:
+      record = self.store.get(table, sys_id)
+      if record is None:
+        return 404, { 'error' : { 'message' : 'No Record found' } }, {}
+      return 200, { 'result' : project(record, fields) }, {}
+
+    if 'GET' == method:
+      try:
+        records = self.store.select(table, params.get('sysparm_query', ''))
+      except ValueError as e:
+        return 400, { 'error' : { 'message' : str(e) } }, {}
+      offset = int(params.get('sysparm_offset', 0) or 0)
+      limit = max(int(params.get('sysparm_limit', 10000) or 10000), 1)
+      page = records[offset:offset + limit]
+      headers = {
+        'X-Total-Count' : str(len(records)),
+        'Link' : self.links(path, params, offset, limit, len(records)),
+      }
+      return 200, { 'result' : [ project(r, fields) for r in page ] }, headers
+
+    if 'POST' == method and not sys_id:
+      return 201, { 'result' : project(self.store.insert(table, body or {}), fields) }, {}
+
+    if method in ('PATCH', 'PUT') and sys_id:
+      record = self.store.update(table, sys_id, body or {})
+      if record is None:
+        return 404, { 'error' : { 'message' : 'No Record found' } }, {}
+      return 200, { 'result' : project(record, fields) }, {}
+
+    if 'DELETE' == method and sys_id:
+      if not self.store.delete(table, sys_id):
+        return 404, { 'error' : { 'message' : 'No Record found' } }, {}
+      return 204, None, {}
+
+    return 405, { 'error' : { 'message' : 'Method not supported' } }, {}
+
+  def stats(self, method, path, params):
+    '''Handle an aggregate API call; only sysparm_count is supported'''
+    table = path[len(STATS_PREFIX):].strip('/')
+    self.count_call("{0} stats {1}".format(method, table))
+    if 'GET' != method or 'true' != params.get('sysparm_count'):
+      return 400, { 'error' : { 'message' : 'Only sysparm_count is supported' } }, {}
+    try:
+      count = self.store.count(table, params.get('sysparm_query', ''))
+    except ValueError as e:
+      return 400, { 'error' : { 'message' : str(e) } }, {}
+    return 200, { 'result' : { 'stats' : { 'count' : str(count) } } }, {}
+
+  def batch(self, body):
+    '''Handle a batch API call by running each request in turn'''
+    self.count_call('POST batch')
+    served = []
+    for request in body.get('rest_requests', []):
+      url = urlparse(request['url'])
+      params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+      payload = None
+      if request.get('body'):
+        payload = json.loads(base64.b64decode(request['body']).decode('utf-8'))
+      status, result, headers = self.table(request['method'], url.path, params, payload, batched=True)
+      encoded = ''
+      if result is not None:
+        encoded = base64.b64encode(json.dumps(result).encode('utf-8')).decode('ascii')
+      served.append({
+        'id' : request['id'],
+        'status_code' : status,
+        'status_text' : 'OK' if status < 300 else 'Error',
+        'body' : encoded,
+        'headers' : [ { 'name' : k, 'value' : v } for k, v in headers.items() ],
+      })
+
+    return 200, {
+      'batch_request_id' : body.get('batch_request_id'),
+      'serviced_requests' : served,
+      'unserviced_requests' : [],
+    }, {}
+
+  def handle(self, method, path, params, body):
+    '''Route one HTTP request, returns (status, body, headers)'''
+    if CALLS_PATH == path:
+      return 200, { 'result' : self.calls() }, {}
+
+    failure = self.inject()
+    if failure is not None:
+      return failure
+    if path.startswith(TABLE_PREFIX):
+      return self.table(method, path, params, body)
+    if path.startswith(STATS_PREFIX):
+      return self.stats(method, path, params)
+    if BATCH_PATH == path and 'POST' == method:
+      return self.batch(body or {})
+    return 404, { 'error' : { 'message' : 'Unknown path' } }, {}
+
+def seed(store, tickets=0, servers=0, group='ANSIBLE', services=10, seed=None):
+  '''Fill store with cmdb_ci_server records and open incidents on them
+
+  Tickets are spread over the servers and services at random, so some share
+  a server, service and remediation and are duplicates of each other.
+  '''
+  rng = random.Random(seed)
+  names = [ "server{0:05d}.example.com".format(i) for i in range(max(servers, 1)) ]
+  for name in names[:servers]:
+    store.insert('cmdb_ci_server', {
+      'name' : name,
+      'host_name' : name,
+      'os' : rng.choice([ 'Linux Red Hat', 'Windows 2016 Standard' ]),
+      'operational_status' : '1',
+    })
+
+  for i in range(tickets):
+    server = rng.choice(names)
+    remediation = rng.choice([ 'complex', 'grouped' ])
+    service = "service{0}".format(rng.randrange(services))
+    store.insert('incident', {
+      'short_description' : "Seeded ticket {0}".format(i),
+      'description' : "Server={0}~Remediation={1}~ServiceName={2}~EscalationGroup=SERVICE DESK".format(
+        server, remediation, service),
+      'assignment_group' : group,
+      'u_host_name' : server,
+      'cmdb_ci' : server,
+      'caller_id' : 'Ansible, User',
+      'priority' : rng.choice([ '1 - Critical', '2 - High', '3 - Moderate', '4 - Low', '5 - Planning' ]),
+    })
+
+class Handler(BaseHTTPRequestHandler):
+  '''HTTP front end of a Simulator'''
+  protocol_version = 'HTTP/1.1'
+  simulator = None
+
+  def log_message(self, format, *args):
+    '''Keep quiet'''
+    pass
+
+  def _dispatch(self):
+    '''Parse the request and send the simulated response'''
+    url = urlparse(self.path)
+    params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+    length = int(self.headers.get('Content-Length') or 0)
+    body = None
+    if length:
+      body = json.loads(self.rfile.read(length).decode('utf-8'))
+
+    status, result, headers = self.simulator.handle(self.command, url.path, params, body)
+
+    data = b'' if result is None else json.dumps(result).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  do_GET = _dispatch
+  do_POST = _dispatch
+  do_PUT = _dispatch
+  do_PATCH = _dispatch
+  do_DELETE = _dispatch
+
+class Server(ThreadingMixIn, HTTPServer):
+  '''One thread per connection'''
+  daemon_threads = True
+
+def make_server(simulator, host='127.0.0.1', port=0):
+  '''HTTP server for simulator; port 0 picks a free port'''
+  handler = type('BoundHandler', (Handler,), { 'simulator' : simulator })
+  return Server((host, port), handler)
+
+def start(simulator=None, host='127.0.0.1', port=0):
+  '''Serve in a background thread, returns (server, simulator)'''
+  simulator = simulator or Simulator()
+  server = make_server(simulator, host, port)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, simulator
+
+def main():
+  '''Script entry point'''
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--tickets', type=int, default=0, help='open incidents to seed')
+  parser.add_argument('--servers', type=int, default=0, help='cmdb_ci_server records to seed')
+  parser.add_argument('--group', default='ANSIBLE', help='assignment group of the seeded incidents')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail')
+  parser.add_argument('--error-status', type=int, default=503, choices=[ 429, 500, 503 ])
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--rate-limit', type=float, default=0, help='calls per second served, the rest get 429')
+  args = parser.parse_args()
+
+  simulator = Simulator(latency=args.latency, error_rate=args.error_rate,
+    error_status=args.error_status, seed=args.seed, rate_limit=args.rate_limit)
+  seed(simulator.store, args.tickets, args.servers, args.group, seed=args.seed)
+  server = make_server(simulator, args.host, args.port)
+  sys.stderr.write("Serving on http://{0}:{1}\n".format(*server.server_address))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+  return EXIT_SUCCESS
+
+if __name__ == '__main__':
+  sys.exit(main())